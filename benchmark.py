@@ -0,0 +1,449 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import islice
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Laskukyselyn sarakkeet samassa järjestyksessä kuin invoice_query.sql:ssä
+INVOICE_COLUMNS = [
+    "ORDER_ID",
+    "CUSTOMER_ID",
+    "CUSTOMER_NAME",
+    "CUSTOMER_EMAIL",
+    "DUE_DATE",
+    "ORDER_LINE_ID",
+    "PRODUCT_ID",
+    "PRODUCT_NAME",
+    "QUANTITY",
+    "UNIT_PRICE",
+    "CUSTOMER_ADDRESS"
+]
+
+SCALES = {"10": 10, "1k": 1_000, "50k": 50_000, "100k": 100_000, "1M": 1_000_000}
+RESULTS_FILE = "benchmark_results.jsonl"
+RENDER_LIMIT = 1000  # Renderöintivaiheissa käsiteltävien laskujen enimmäismäärä
+SEED = 42
+
+# ---------------------------------------------------------------------------
+# Synteettinen AdventureWorksLT-muotoinen aineisto
+# ---------------------------------------------------------------------------
+
+def generate_invoice_rows(lines, lines_per_order=12, customers=None, products=300, seed=SEED):
+    """
+    Yield synthetic invoice query rows shaped like the SalesLT join:
+    orders with a random number of detail lines, each pointing at a
+    customer, a product and a customer address. Rows are ordered by ORDER_ID.
+    """
+    rng = random.Random(seed)
+    customers = customers or max(1, lines // 50)
+    product_names = [f"HL Road Frame - Black, {44 + i % 20} #{i}" for i in range(products)]
+    product_prices = [Decimal(rng.randint(200, 300000)) / 100 for _ in range(products)]
+    base_date = datetime(2008, 6, 1)
+
+    order_id = 71774
+    line_id = 110562
+    produced = 0
+    while produced < lines:
+        customer_id = 29485 + rng.randrange(customers)
+        due_date = base_date + timedelta(days=rng.randrange(365))
+        for _ in range(min(rng.randint(1, 2 * lines_per_order - 1), lines - produced)):
+            product = rng.randrange(products)
+            yield (
+                order_id,
+                customer_id,
+                f"Company {customer_id}",
+                f"customer{customer_id}@adventure-works.com",
+                due_date,
+                line_id,
+                680 + product,
+                product_names[product],
+                rng.randint(1, 25),
+                product_prices[product].quantize(Decimal("0.0001")),
+                1000 + customer_id % 500
+            )
+            line_id += 1
+            produced += 1
+        order_id += 1
+
+def generate_order_groups(lines, **options):
+    """Group synthetic rows into (order_id, items) pairs with dict items."""
+    current_id = None
+    items = []
+    for row in generate_invoice_rows(lines, **options):
+        item = dict(zip(INVOICE_COLUMNS, row))
+        if items and item["ORDER_ID"] != current_id:
+            yield current_id, items
+            items = []
+        current_id = item["ORDER_ID"]
+        items.append(item)
+    if items:
+        yield current_id, items
+
+# SalesLT-taulujen sarakkeet ja vierasavaimet synteettistä katalogia varten
+SALESLT_TABLES = {
+    "SalesOrderHeader": ["SalesOrderID", "OrderDate", "DueDate", "CustomerID", "ShipToAddressID",
+                         "BillToAddressID", "SubTotal", "ModifiedDate"],
+    "SalesOrderDetail": ["SalesOrderID", "SalesOrderDetailID", "OrderQty", "ProductID", "UnitPrice",
+                         "LineTotal", "ModifiedDate"],
+    "Customer": ["CustomerID", "FirstName", "LastName", "CompanyName", "EmailAddress", "ModifiedDate"],
+    "CustomerAddress": ["CustomerID", "AddressID", "AddressType", "ModifiedDate"],
+    "Address": ["AddressID", "AddressLine1", "City", "ModifiedDate"],
+    "Product": ["ProductID", "Name", "ProductNumber", "ListPrice", "ModifiedDate"]
+}
+SALESLT_FOREIGN_KEYS = [
+    ("SalesOrderHeader", "CustomerID", "Customer", "CustomerID"),
+    ("SalesOrderHeader", "ShipToAddressID", "Address", "AddressID"),
+    ("SalesOrderHeader", "BillToAddressID", "Address", "AddressID"),
+    ("SalesOrderDetail", "SalesOrderID", "SalesOrderHeader", "SalesOrderID"),
+    ("SalesOrderDetail", "ProductID", "Product", "ProductID"),
+    ("CustomerAddress", "CustomerID", "Customer", "CustomerID"),
+    ("CustomerAddress", "AddressID", "Address", "AddressID")
+]
+
+def generate_catalog(columns, columns_per_table=25, seed=SEED):
+    """
+    Build a synthetic INFORMATION_SCHEMA catalog with the SalesLT tables and
+    filler tables up to the given column count. Filler tables reuse column
+    names such as Name and CustomerID and reference the SalesLT tables, so
+    the resolver has to pick the right table rather than the first match.
+    """
+    rng = random.Random(seed)
+    catalog = []
+    relationships = []
+
+    def add_fk(parent_schema, parent, parent_column, referenced_schema, referenced, referenced_column):
+        relationships.append({
+            "parent_schema": parent_schema, "parent_table": parent, "parent_column": parent_column,
+            "referenced_schema": referenced_schema, "referenced_table": referenced,
+            "referenced_column": referenced_column
+        })
+
+    filler_count = max(0, columns - sum(len(cols) for cols in SALESLT_TABLES.values())) // columns_per_table
+    for i in range(filler_count):
+        schema = f"Dept{i % 50}"
+        table = f"Table{i}"
+        names = ["Name", "CustomerID", "ModifiedDate"] + [f"Attribute{j}" for j in range(columns_per_table - 3)]
+        catalog.extend({"TABLE_SCHEMA": schema, "TABLE_NAME": table, "COLUMN_NAME": name,
+                        "DATA_TYPE": "nvarchar"} for name in names)
+        add_fk(schema, table, "CustomerID", "SalesLT", rng.choice(["Customer", "CustomerAddress"]), "CustomerID")
+
+    for table, names in SALESLT_TABLES.items():
+        catalog.extend({"TABLE_SCHEMA": "SalesLT", "TABLE_NAME": table, "COLUMN_NAME": name,
+                        "DATA_TYPE": "int"} for name in names)
+    for parent, parent_column, referenced, referenced_column in SALESLT_FOREIGN_KEYS:
+        add_fk("SalesLT", parent, parent_column, "SalesLT", referenced, referenced_column)
+
+    catalog.sort(key=lambda col: (col["TABLE_SCHEMA"], col["TABLE_NAME"], col["COLUMN_NAME"]))
+    return catalog, relationships
+
+# ---------------------------------------------------------------------------
+# DB-API-yhteensopiva testitietokanta
+# ---------------------------------------------------------------------------
+
+class FakeCursor:
+    """
+    Minimal pymssql-like cursor that serves synthetic invoice rows.
+    """
+
+    def __init__(self, connection, as_dict=False):
+        self.connection = connection
+        self.as_dict = as_dict
+        self.description = None
+        self._rows = iter(())
+        self._columns = []
+
+    def execute(self, query, params=None):
+        self.connection.queries.append((query, params))
+        if "EXISTS" in query:
+            self._columns = ["HAS_ORDERS"]
+            self._rows = iter([(1 if self.connection.lines else 0,)])
+        else:
+            self._columns = INVOICE_COLUMNS
+            self._rows = generate_invoice_rows(self.connection.lines, **self.connection.options)
+        self.description = [(name, None, None, None, None, None, None) for name in self._columns]
+
+    def fetchmany(self, size=1):
+        rows = list(islice(self._rows, size))
+        if self.as_dict:
+            return [dict(zip(self._columns, row)) for row in rows]
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchall(self):
+        rows = []
+        while True:
+            batch = self.fetchmany(10000)
+            if not batch:
+                return rows
+            rows.extend(batch)
+
+    def close(self):
+        self._rows = iter(())
+
+class FakeConnection:
+    """
+    Minimal pymssql-like connection for the benchmark.
+    """
+
+    def __init__(self, lines, **options):
+        self.lines = lines
+        self.options = options
+        self.queries = []
+
+    def cursor(self, as_dict=False):
+        return FakeCursor(self, as_dict)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def use_fake_database(lines, **options):
+    """Route the shared connection pool to a FakeConnection with synthetic rows."""
+    from db_pool import configure_pool
+    configure_pool(lambda: FakeConnection(lines, **options))
+
+# ---------------------------------------------------------------------------
+# Vaiheet
+# ---------------------------------------------------------------------------
+
+def bench_group(lines, args):
+    """Stream and group rows through db_handler.iter_orders_by_invoice()."""
+    from db_handler import iter_orders_by_invoice
+    use_fake_database(lines)
+    invoices = 0
+    for _order_id, _items in iter_orders_by_invoice():
+        invoices += 1
+    return {"rows": lines, "invoices": invoices}
+
+def bench_retain(lines, args):
+    """
+    Fetch all order groups into memory with db_handler.group_orders_by_invoice(),
+    so the peak RSS shows the memory cost per order line.
+    """
+    from db_handler import group_orders_by_invoice
+    use_fake_database(lines)
+    grouped = group_orders_by_invoice() or {}
+    return {"rows": sum(len(items) for items in grouped.values()), "invoices": len(grouped)}
+
+def bench_xml(lines, args):
+    """Render XML invoices into memory with invoice_generator.generate_xml()."""
+    from invoice_generator import generate_xml
+    rows = invoices = bytes_written = 0
+    for order_id, items in islice(generate_order_groups(lines), args.render_limit):
+        buffer = io.BytesIO()
+        generate_xml(order_id, items[0]["CUSTOMER_NAME"], items[0]["CUSTOMER_NAME"],
+                     items[0]["DUE_DATE"], items, buffer)
+        rows += len(items)
+        invoices += 1
+        bytes_written += buffer.tell()
+    return {"rows": rows, "invoices": invoices, "bytes": bytes_written}
+
+def bench_pdf(lines, args):
+    """Render PDF invoices into memory with invoice_generator.generate_pdf()."""
+    from invoice_generator import generate_pdf
+    rows = invoices = bytes_written = 0
+    for order_id, items in islice(generate_order_groups(lines), args.render_limit):
+        buffer = io.BytesIO()
+        generate_pdf(order_id, items[0]["CUSTOMER_NAME"], items[0]["CUSTOMER_NAME"],
+                     items[0]["DUE_DATE"], items, buffer)
+        rows += len(items)
+        invoices += 1
+        bytes_written += buffer.tell()
+    return {"rows": rows, "invoices": invoices, "bytes": bytes_written}
+
+def bench_xml_stream(lines, args):
+    """
+    Check that streamed XML is byte-identical to the tree-based output for the
+    first invoices, then stream one consolidated invoice with every line into
+    a file with invoice_generator.generate_xml(streaming=True).
+    """
+    from invoice_generator import generate_xml
+    for order_id, items in islice(generate_order_groups(lines), args.render_limit):
+        outputs = []
+        for streaming in (False, True):
+            buffer = io.BytesIO()
+            generate_xml(order_id, items[0]["CUSTOMER_NAME"], items[0]["CUSTOMER_NAME"],
+                         items[0]["DUE_DATE"], items, buffer, streaming=streaming)
+            outputs.append(buffer.getvalue())
+        if outputs[0] != outputs[1]:
+            raise AssertionError(f"Streamed XML of order {order_id} differs from the tree output")
+
+    items = [item for _order_id, order_items in generate_order_groups(lines) for item in order_items]
+    start = time.perf_counter()
+    generate_xml(0, items[0]["CUSTOMER_NAME"], items[0]["CUSTOMER_NAME"], items[0]["DUE_DATE"],
+                 items, "consolidated.xml", streaming=True)
+    return {"rows": len(items), "invoices": 1, "bytes": os.path.getsize("consolidated.xml"),
+            "seconds": time.perf_counter() - start}
+
+def bench_pdf_order(lines, args):
+    """
+    Render one PDF invoice with every line (e.g. --scales 10 1k 50k), so long
+    orders go through the paginated invoice_generator.generate_pdf() path.
+    """
+    from invoice_generator import generate_pdf
+    items = [item for _order_id, order_items in generate_order_groups(lines) for item in order_items]
+    buffer = io.BytesIO()
+    start = time.perf_counter()
+    generate_pdf(0, items[0]["CUSTOMER_NAME"], items[0]["CUSTOMER_NAME"], items[0]["DUE_DATE"], items, buffer)
+    return {"rows": len(items), "invoices": 1, "bytes": buffer.tell(), "seconds": time.perf_counter() - start}
+
+def bench_storage(lines, args):
+    """Store rendered XML invoices with blob_handler.upload_files_to_blob() into a local directory."""
+    from blob_handler import InMemoryFile, LocalDirectoryBackend, upload_files_to_blob
+    from invoice_generator import generate_xml
+
+    files = []
+    rows = bytes_written = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for order_id, items in islice(generate_order_groups(lines), args.render_limit):
+            buffer = io.BytesIO()
+            generate_xml(order_id, items[0]["CUSTOMER_NAME"], items[0]["CUSTOMER_NAME"],
+                         items[0]["DUE_DATE"], items, buffer)
+            files.append((InMemoryFile(f"{order_id}.xml", buffer.getvalue()),))
+            rows += len(items)
+            bytes_written += buffer.tell()
+
+    backend = LocalDirectoryBackend(os.path.join(os.getcwd(), "output_files"))
+    start = time.perf_counter()
+    upload_files_to_blob(files, backend)
+    return {"rows": rows, "invoices": len(files), "bytes": bytes_written,
+            "seconds": time.perf_counter() - start}
+
+def bench_schema(lines, args):
+    """
+    Resolve the invoice fields and joins with scan_schema.find_required_tables()
+    against a synthetic catalog of the given number of columns, and check
+    that every field resolves to the expected SalesLT table.
+    """
+    # scan_schema lukee asetukset tuonnin yhteydessä; mittaus ei avaa yhteyttä
+    for key in ("DB_SERVER", "DB_NAME", "DB_USER", "DB_PASSWORD"):
+        os.environ.setdefault(key, "benchmark.database.windows.net" if key == "DB_SERVER" else "benchmark")
+    from scan_schema import FIELD_TABLE_MAPPING, REQUIRED_FIELDS, REQUIRED_JOINS, find_required_tables
+
+    columns, relationships = generate_catalog(lines)
+    start = time.perf_counter()
+    field_locations, table_relationships = find_required_tables(columns, relationships, REQUIRED_FIELDS)
+    seconds = time.perf_counter() - start
+
+    for field, table in FIELD_TABLE_MAPPING.items():
+        location = field_locations.get(field)
+        if not location or (location["schema"], location["table"]) != ("SalesLT", table):
+            raise AssertionError(f"{field} resolved to {location}, expected SalesLT.{table}")
+    join_count = sum(len(joins) for joins in table_relationships.values())
+    if join_count != len(REQUIRED_JOINS):
+        raise AssertionError(f"Resolved {join_count} joins, expected {len(REQUIRED_JOINS)}")
+
+    return {"rows": len(columns), "invoices": 0, "seconds": seconds}
+
+STAGES = {
+    "group": bench_group,
+    "retain": bench_retain,
+    "xml": bench_xml,
+    "xml_stream": bench_xml_stream,
+    "pdf": bench_pdf,
+    "pdf_order": bench_pdf_order,
+    "storage": bench_storage,
+    "schema": bench_schema
+}
+
+# ---------------------------------------------------------------------------
+# Ajo
+# ---------------------------------------------------------------------------
+
+def peak_rss_kb():
+    """Peak resident set size of the current process in kilobytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def run_stage(stage, scale, args):
+    """
+    Run one stage in the current process and return its measurements.
+    Console output of the stage is discarded so it does not skew the timing.
+    """
+    # Vaihe ajetaan väliaikaisessa kansiossa, jotta oikeat tiedostot eivät muutu
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="invoice-bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            with open("invoice_query.sql", "w") as f:
+                f.write("SELECT * FROM SyntheticInvoiceRows ORDER BY ORDER_ID;")
+
+            # Tuo moduulit ennen ajanottoa, jotta importit eivät näy tuloksissa
+            import blob_handler, db_handler, invoice_generator  # noqa: F401
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = STAGES[stage](SCALES[scale], args)
+            seconds = result.pop("seconds", time.perf_counter() - start)
+        finally:
+            os.chdir(original_dir)
+
+    result.update({
+        "stage": stage,
+        "scale": scale,
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(result["rows"] / seconds, 1) if seconds else None,
+        "invoices_per_sec": round(result["invoices"] / seconds, 1) if seconds else None,
+        "peak_rss_kb": peak_rss_kb()
+    })
+    return result
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Mittaa laskuintegraation vaiheiden suorituskykyä synteettisellä aineistolla.")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["1k", "100k"],
+                        help="Aineiston koot riveinä (oletus: 1k 100k)")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES),
+                        help="Mitattavat vaiheet (oletus: kaikki)")
+    parser.add_argument("--render-limit", type=int, default=RENDER_LIMIT,
+                        help=f"Renderöitävien laskujen enimmäismäärä vaihetta kohden (oletus: {RENDER_LIMIT})")
+    parser.add_argument("--output", default=RESULTS_FILE,
+                        help=f"JSON Lines -tiedosto, johon tulokset lisätään (oletus: {RESULTS_FILE})")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    timestamp = datetime.now().isoformat(timespec="seconds")
+
+    print(f"{'stage':<10}{'scale':>6}{'rows':>10}{'invoices':>10}{'seconds':>10}{'rows/s':>12}{'inv/s':>10}{'peak RSS':>12}")
+    for scale in args.scales:
+        for stage in args.stages:
+            # Jokainen vaihe ajetaan omassa prosessissaan, jotta huippumuisti on vertailukelpoinen
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_stage, stage, scale, args).result()
+            result["timestamp"] = timestamp
+
+            print(f"{stage:<10}{scale:>6}{result['rows']:>10}{result['invoices']:>10}"
+                  f"{result['seconds']:>10.2f}{result['rows_per_sec'] or 0:>12.0f}"
+                  f"{result['invoices_per_sec'] or 0:>10.1f}{result['peak_rss_kb'] or 0:>10} kB")
+            with open(output, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    print(f"\n✅ Tulokset lisätty tiedostoon {output}")
+
+if __name__ == "__main__":
+    main()
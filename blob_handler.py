@@ -1,44 +1,177 @@
+import logging
 import os
+import shutil
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from metrics import count, timed
+
+log = logging.getLogger(__name__)
 
 # Environment variables
 blob_sas_url = os.getenv("BLOB_STRING")
 blob_container = os.getenv("BLOB_CONTAINER")
 
-def upload_files_to_blob(files):
+# Latausvaiheen asetukset
+UPLOAD_WORKERS = 4  # Samanaikaisten latausten määrä
+CHUNK_SIZE = 4 * 1024 * 1024  # Tiedostot siirretään 4 MB paloina
+MAX_RETRIES = 3  # Uusintayritykset epäonnistuneelle tiedostolle
+RETRY_BACKOFF = 1.0  # Sekuntia, tuplataan jokaisella yrityksellä
+
+# Muistiin renderöity tiedosto, joka ladataan ilman väliaikaistiedostoa
+InMemoryFile = namedtuple("InMemoryFile", ["name", "data"])
+
+class LocalDirectoryBackend:
+    """
+    Tallenna tiedostot paikalliseen kansioon.
+    """
+    name = "local"
+
+    def __init__(self, directory="output_files"):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def upload_file(self, path):
+        """Copy a file into the output directory in fixed-size chunks."""
+        target = os.path.join(self.directory, os.path.basename(path))
+        with open(path, "rb") as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        return target
+
+    def upload_bytes(self, name, data):
+        """Write an in-memory file into the output directory."""
+        target = os.path.join(self.directory, name)
+        with open(target, "wb") as dst:
+            dst.write(data)
+        return target
+
+class AzureBlobBackend:
     """
-    Tallenna tiedostot paikallisesti, koska Azure Blob Storage ei ole käytettävissä.
+    Lataa tiedostot Azure Blob Storage -containeriin.
+    BLOB_STRING voi olla SAS-osoite tai yhteysmerkkijono.
+    """
+    name = "azure"
+
+    def __init__(self, blob_string=None, container=None):
+        try:
+            from azure.storage.blob import BlobServiceClient
+        except ImportError:
+            raise RuntimeError("azure-storage-blob ei ole asennettu (pip install -r requirements.txt)")
+
+        blob_string = blob_string or blob_sas_url
+        container = container or blob_container
+        if not blob_string or not container:
+            raise RuntimeError("BLOB_STRING ja BLOB_CONTAINER on asetettava Azure-latausta varten")
+
+        # Isot tiedostot ladataan CHUNK_SIZE-kokoisina lohkoina
+        client_options = {"max_block_size": CHUNK_SIZE, "max_single_put_size": CHUNK_SIZE}
+        if blob_string.startswith("http"):
+            service = BlobServiceClient(account_url=blob_string, **client_options)
+        else:
+            service = BlobServiceClient.from_connection_string(blob_string, **client_options)
+        self.container_client = service.get_container_client(container)
+
+    def upload_file(self, path):
+        """Upload a file as a block blob, streamed from disk."""
+        blob_name = os.path.basename(path)
+        with open(path, "rb") as data:
+            self.container_client.upload_blob(blob_name, data, overwrite=True)
+        return f"{self.container_client.container_name}/{blob_name}"
+
+    def upload_bytes(self, name, data):
+        """Upload an in-memory file as a block blob."""
+        self.container_client.upload_blob(name, data, overwrite=True)
+        return f"{self.container_client.container_name}/{name}"
+
+BACKENDS = {
+    LocalDirectoryBackend.name: LocalDirectoryBackend,
+    AzureBlobBackend.name: AzureBlobBackend
+}
+
+def get_backend(name="local"):
+    """Create the storage backend with the given name."""
+    if name not in BACKENDS:
+        raise ValueError(f"Tuntematon tallennuskohde: {name} (vaihtoehdot: {', '.join(BACKENDS)})")
+    return BACKENDS[name]()
+
+def describe(path):
+    """Return a printable name for a file path or InMemoryFile."""
+    return path.name if isinstance(path, InMemoryFile) else path
+
+@timed("upload_file")
+def upload_with_retry(backend, path):
+    """
+    Upload one file path or InMemoryFile, retrying with exponential backoff.
+    """
+    delay = RETRY_BACKOFF
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            if isinstance(path, InMemoryFile):
+                target = backend.upload_bytes(path.name, path.data)
+                count("bytes_uploaded", len(path.data))
+            else:
+                target = backend.upload_file(path)
+                count("bytes_uploaded", os.path.getsize(path))
+            count("files_uploaded")
+            return target
+        except Exception as e:
+            if attempt == MAX_RETRIES:
+                raise
+            log.warning(f"⚠️ Lataus epäonnistui ({describe(path)}), yritys {attempt}/{MAX_RETRIES}: {e}")
+            time.sleep(delay)
+            delay *= 2
+
+@timed("upload")
+def upload_files_to_blob(files, backend=None, workers=UPLOAD_WORKERS):
+    """
+    Upload (xml_file, pdf_file) pairs to the storage backend using a bounded
+    thread pool. Defaults to the local directory backend while Azure Blob
+    Storage is not available. Each file may be a path or an InMemoryFile.
+    Files may be any iterable, e.g. a generator of freshly rendered invoices:
+    pairs are consumed lazily and at most 2 * workers uploads are in flight,
+    so a slow upload stage applies backpressure to the producer.
+    Returns True if every file was uploaded.
     """
     try:
-        # Luo output-kansio jos ei ole olemassa
-        local_output = "output_files"
-        os.makedirs(local_output, exist_ok=True)
-        
-        for xml_file, pdf_file in files:
-            # Kopioi XML
-            if os.path.exists(xml_file):
-                new_xml = os.path.join(local_output, os.path.basename(xml_file))
-                with open(xml_file, "rb") as src, open(new_xml, "wb") as dst:
-                    dst.write(src.read())
-                print(f"✅ Tallennettu paikallisesti: {new_xml}")
-
-            # Kopioi PDF
-            if os.path.exists(pdf_file):
-                new_pdf = os.path.join(local_output, os.path.basename(pdf_file))
-                with open(pdf_file, "rb") as src, open(new_pdf, "wb") as dst:
-                    dst.write(src.read())
-                print(f"✅ Tallennettu paikallisesti: {new_pdf}")
-
-        print(f"""
-✅ Tiedostot tallennettu paikallisesti kansioon '{local_output}'
+        if backend is None:
+            backend = get_backend()
+
+        failed = 0
+        in_flight = deque()  # (path, future) in submission order
+
+        def wait_oldest():
+            nonlocal failed
+            path, future = in_flight.popleft()
+            try:
+                target = future.result()
+                log.debug(f"✅ Tallennettu: {target}")
+            except Exception as e:
+                failed += 1
+                log.warning(f"⚠️ Virhe tiedoston {describe(path)} tallennuksessa: {e}")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for pair in files:
+                for path in pair:
+                    if not isinstance(path, InMemoryFile) and not os.path.exists(path):
+                        continue
+                    in_flight.append((path, executor.submit(upload_with_retry, backend, path)))
+                    if len(in_flight) >= workers * 2:
+                        wait_oldest()
+            while in_flight:
+                wait_oldest()
+
+        if backend.name == LocalDirectoryBackend.name:
+            print(f"""
+✅ Tiedostot tallennettu paikallisesti kansioon '{backend.directory}'
 ⚠️ Azure Blob Storage ei käytettävissä - tilaus deaktivoitu.
 
 Voit:
 1. Aktivoida Azure-tilauksen uudelleen
 2. Jatkaa tiedostojen paikallista tallennusta
 """)
-        return True
+        return failed == 0
 
     except Exception as e:
         print(f"⚠️ Virhe tiedostojen tallennuksessa: {str(e)}")
-        return False
\ No newline at end of file
+        return False
@@ -1,6 +1,7 @@
 import pymssql
 import os
 from config import load_config
+from db_pool import get_connection
 
 # Lataa asetukset
 config = load_config()
@@ -17,25 +18,20 @@ print("DB_SERVER:", server)
 print("DB_NAME:", database)
 
 try:
-    # Connect to SQL Server
-    conn = pymssql.connect(
-        server=server,
-        user=f"{username}@{server.split('.')[0]}",
-        password=password,
-        database=database
-    )
-    print("✅ Connected to the database successfully!")
+    # Connect to SQL Server through the shared connection pool
+    with get_connection() as conn:
+        print("✅ Connected to the database successfully!")
 
-    # Create a cursor
-    cursor = conn.cursor()
+        # Create a cursor
+        cursor = conn.cursor()
 
-    # Fetch all table columns from INFORMATION_SCHEMA.COLUMNS
-    cursor.execute("""
-        SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME
-        FROM INFORMATION_SCHEMA.COLUMNS
-        ORDER BY TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME;
-    """)
-    columns = cursor.fetchall()
+        # Fetch all table columns from INFORMATION_SCHEMA.COLUMNS
+        cursor.execute("""
+            SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME
+            FROM INFORMATION_SCHEMA.COLUMNS
+            ORDER BY TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME;
+        """)
+        columns = cursor.fetchall()
 
     # Organize columns by table
     table_columns = {}
@@ -93,9 +89,6 @@ try:
             alias = table_aliases.get(table, "")
             print(f" - {field}: {table}.{col} (alias: {alias})")
 
-    # Close the connection
-    conn.close()
-
 except pymssql.InterfaceError as e:
     print(f"⚠️ Connection failed: {e}")
 except pymssql.DatabaseError as e:
@@ -1,37 +1,39 @@
+import logging
 import pymssql
 import os
-from collections import defaultdict
+import re
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from config import load_config
+from db_pool import POOL_SIZE, get_connection, get_pool
+from metrics import count, timer
 
-# Lataa asetukset
-config = load_config()
-if not config:
-    raise Exception("Asetukset puuttuvat!")
+load_dotenv()
 
-# Käytä asetuksia
-server = config["DB_SERVER"]
-database = config["DB_NAME"]
-username = config["DB_USER"]
-password = config["DB_PASSWORD"]
+log = logging.getLogger(__name__)
 
-load_dotenv()
+# Kuinka monta riviä haetaan kerralla fetchmany()-kutsulla
+FETCH_BATCH_SIZE = 1000
+
+# Sivutetussa haussa tilaukset haetaan PAGE_SIZE tilauksen sivuina rinnakkain
+PAGE_SIZE = 500
+FETCH_WORKERS = POOL_SIZE
+
+# Normalisoidussa haussa tilauksen otsikkotiedot haetaan kerran per tilaus
+# ja laskurivit omana tulosjoukkonaan
+HEADER_FIELDS = ("ORDER_ID", "CUSTOMER_ID", "CUSTOMER_NAME", "CUSTOMER_EMAIL", "DUE_DATE", "CUSTOMER_ADDRESS")
+LINE_FIELDS = ("ORDER_ID", "ORDER_LINE_ID", "PRODUCT_ID", "PRODUCT_NAME", "QUANTITY", "UNIT_PRICE")
 
-def fetch_data(query):
+def fetch_data(query, params=None):
     """
     Fetch data from the database using the provided SQL query.
     """
     try:
-        # Establish connection
-        with pymssql.connect(
-            server=server,
-            user=f"{username}@{server.split('.')[0]}", 
-            password=password,
-            database=database
-        ) as conn:
+        # Borrow a pooled connection
+        with get_connection() as conn:
 
             cursor = conn.cursor(as_dict=True) 
-            cursor.execute(query)
+            cursor.execute(query, params)
             results = cursor.fetchall()
             return results
 
@@ -62,7 +64,8 @@ def fetch_order_details():
     if not base_query:
         return None  # If no query, return empty
 
-    print("\n✅ Executing Dynamic Query:\n", base_query)
+    print("\n✅ Executing Dynamic Query")
+    log.debug(base_query)
 
     try:
         data = fetch_data(base_query)
@@ -72,55 +75,522 @@ def fetch_order_details():
 
     
     if data:
-        print("✅ Successfully retrieved order details:")
-        for row in data:
-            print(row)  # Print detailed order data
+        print(f"✅ Successfully retrieved {len(data)} order detail rows.")
+        if log.isEnabledFor(logging.DEBUG):
+            for row in data:
+                log.debug(row)  # Print detailed order data
     else:
         print("⚠️ No order details found.")
     
     return data
 
-def group_orders_by_invoice():
+def read_invoice_query():
     """
-    Fetch and group order details from database using the generated query.
+    Read the generated invoice query from invoice_query.sql.
+    """
+    with open("invoice_query.sql", "r") as f:
+        return f.read()
+
+def strip_order_by(sql_query):
+    """
+    Remove the trailing ORDER BY clause and semicolon so the query can be
+    used as a subquery.
+    """
+    return re.sub(r"\s+ORDER\s+BY\s+[^()]*?;?\s*$", "", sql_query.strip(), flags=re.IGNORECASE).rstrip(";")
+
+def order_id_filter(min_order_id=None, max_order_id=None, column="invoice_rows.ORDER_ID"):
+    """
+    Return the WHERE clause and parameters that limit the order ID column
+    to the range (min_order_id, max_order_id]. Either bound may be None.
+    """
+    conditions = []
+    params = []
+    if min_order_id is not None:
+        conditions.append(f"{column} > %s")
+        params.append(min_order_id)
+    if max_order_id is not None:
+        conditions.append(f"{column} <= %s")
+        params.append(max_order_id)
+    if not conditions:
+        return "", None
+    return "WHERE " + " AND ".join(conditions), tuple(params)
+
+def build_invoice_query(min_order_id=None, max_order_id=None, by_customer=False):
+    """
+    Build the invoice query and its parameters.
+    With min_order_id only orders with a greater ORDER_ID are returned, and
+    with max_order_id only orders up to and including it. The generated
+    query is wrapped as a derived table so the filter works for any
+    generated column names and is pushed down by the optimizer.
+    The lines of an order are ordered by ORDER_LINE_ID, and with by_customer
+    the orders by CUSTOMER_ID, then ORDER_ID.
+    """
+    sql_query = read_invoice_query()
+    where, params = order_id_filter(min_order_id, max_order_id)
+    if not where and not by_customer:
+        return sql_query, None
+
+    order_by = "invoice_rows.ORDER_ID, invoice_rows.ORDER_LINE_ID"
+    if by_customer:
+        order_by = "invoice_rows.CUSTOMER_ID, " + order_by
+    filtered_query = f"""SELECT *
+FROM (
+{strip_order_by(sql_query)}
+) AS invoice_rows
+{where}
+ORDER BY {order_by};"""
+    return filtered_query, params
+
+def has_orders(min_order_id=None, max_order_id=None):
+    """
+    Check whether the invoice query returns any rows without transferring them.
+    Returns True/False, or None if the check itself failed.
+    """
+    try:
+        sql_query, params = build_invoice_query(min_order_id, max_order_id)
+        inner_query = strip_order_by(sql_query)
+        data = fetch_data(f"SELECT CASE WHEN EXISTS ({inner_query}) THEN 1 ELSE 0 END AS HAS_ORDERS", params)
+    except Exception as e:
+        print(f"⚠️ Odottamaton virhe: {e}")
+        return None
+
+    if data is None:
+        return None
+    return bool(data[0]['HAS_ORDERS'])
+
+class CompactRow:
+    """
+    Base for __slots__ row types. Supports the read-only dict access used by
+    the invoice generators: row["FIELD"], row.get("FIELD", default), keys().
+    Columns missing from the query are left unset and behave like missing keys.
+    """
+    __slots__ = ()
+    FIELDS = ()
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def keys(self):
+        return [field for field in self.FIELDS if hasattr(self, field)]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+class OrderHeader(CompactRow):
+    """Order-level columns, stored once and shared by all lines of the order."""
+    __slots__ = HEADER_FIELDS
+    FIELDS = HEADER_FIELDS
+
+class OrderLine(CompactRow):
+    """
+    One invoice line. Header fields are looked up from the shared OrderHeader
+    and any columns outside the known fields are kept in a small extra dict.
+    """
+    __slots__ = LINE_FIELDS + ("header", "extra")
+    FIELDS = LINE_FIELDS
+
+    def __getitem__(self, key):
+        if key in LINE_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        header = getattr(self, "header", None)
+        if header is not None and key in HEADER_FIELDS:
+            return header[key]
+        extra = getattr(self, "extra", None)
+        if extra and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def keys(self):
+        keys = super().keys()
+        header = getattr(self, "header", None)
+        if header is not None:
+            keys += [key for key in header.keys() if key not in keys]
+        return keys + list(getattr(self, "extra", None) or ())
+
+def header_row_factory(columns):
+    """Return a function that turns a result tuple into an OrderHeader."""
+    indexed = [(i, column) for i, column in enumerate(columns) if column in HEADER_FIELDS]
+
+    def make(values):
+        header = OrderHeader()
+        for i, column in indexed:
+            setattr(header, column, values[i])
+        return header
+    return make
+
+def line_row_factory(columns):
+    """
+    Return a function that turns a result tuple into an OrderLine.
+    Consecutive rows with identical header columns share one OrderHeader.
+    """
+    line_columns = [(i, column) for i, column in enumerate(columns) if column in LINE_FIELDS]
+    header_columns = [(i, column) for i, column in enumerate(columns)
+                      if column in HEADER_FIELDS and column not in LINE_FIELDS]
+    extra_columns = [(i, column) for i, column in enumerate(columns)
+                     if column not in LINE_FIELDS and column not in HEADER_FIELDS]
+    previous = None  # (otsikkosarakkeiden arvot, OrderHeader)
+
+    def make(values):
+        nonlocal previous
+        line = OrderLine()
+        for i, column in line_columns:
+            setattr(line, column, values[i])
+        if header_columns:
+            key = tuple(values[i] for i, _ in header_columns)
+            if previous is None or previous[0] != key:
+                header = OrderHeader()
+                for i, column in header_columns:
+                    setattr(header, column, values[i])
+                previous = (key, header)
+            line.header = previous[1]
+        if extra_columns:
+            line.extra = {column: values[i] for i, column in extra_columns}
+        return line
+    return make
+
+def build_normalized_queries(min_order_id=None, max_order_id=None):
+    """
+    Build the header and line queries for the normalized fetch mode.
+    Both select from the generated query as a derived table: the header
+    query returns one row per order and the line query only the line
+    columns, both ordered by ORDER_ID. Returns (header_query, line_query, params).
+    """
+    inner_query = strip_order_by(read_invoice_query())
+    where, params = order_id_filter(min_order_id, max_order_id)
+
+    def select(distinct, fields, order_by):
+        columns = ", ".join(f"invoice_rows.{field}" for field in fields)
+        return f"""SELECT {distinct}{columns}
+FROM (
+{inner_query}
+) AS invoice_rows
+{where}
+ORDER BY {order_by};"""
+
+    header_query = select("DISTINCT ", HEADER_FIELDS, "invoice_rows.ORDER_ID")
+    line_query = select("", LINE_FIELDS, "invoice_rows.ORDER_ID, invoice_rows.ORDER_LINE_ID")
+    return header_query, line_query, params
+
+def iter_row_batches(sql_query, params=None, batch_size=FETCH_BATCH_SIZE, row_factory=line_row_factory):
+    """
+    Stream the rows of a query from a pooled connection as fetchmany() batches.
+    Rows are fetched as tuples and converted with row_factory(column_names).
+    A connection whose result set was not read to the end is discarded.
     """
+    pool = get_pool()
+    conn = pool.acquire()
+    finished = False
     try:
-        # Lue generoitu SQL-kysely tiedostosta
-        with open("invoice_query.sql", "r") as f:
-            sql_query = f.read()
-        
-        print("\n✅ Käytetään generoitua kyselyä:")
-        print(sql_query)
-        
-        conn = pymssql.connect(
-            server=server,
-            user=f"{username}@{server.split('.')[0]}",
-            password=password,
-            database=database
-        )
-        cursor = conn.cursor(as_dict=True)
-        
-        cursor.execute(sql_query)
-        orders = cursor.fetchall()
-        
-        if not orders:
-            print("⚠️ Tilauksia ei löytynyt.")
-            return None
-            
-        # Ryhmittele tilaukset ORDER_ID:n mukaan
-        grouped_orders = {}
-        for order in orders:
-            order_id = order['ORDER_ID']
-            if order_id not in grouped_orders:
-                grouped_orders[order_id] = []
-            grouped_orders[order_id].append(order)
-            
-        conn.close()
-        return grouped_orders
+        cursor = conn.cursor()
+        with timer("query"):
+            cursor.execute(sql_query, params)
+        make_row = row_factory([column[0] for column in cursor.description])
+        while True:
+            with timer("fetch_rows"):
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            count("rows_fetched", len(rows))
+            yield [make_row(row) for row in rows]
+        finished = True
+    finally:
+        # Kesken jäänyttä tulosjoukkoa ei palauteta pooliin
+        pool.release(conn, discard=not finished)
+
+def iter_rows(sql_query, params=None, batch_size=FETCH_BATCH_SIZE, row_factory=line_row_factory):
+    """Stream the rows of a query one at a time, see iter_row_batches()."""
+    batches = iter_row_batches(sql_query, params, batch_size, row_factory)
+    try:
+        for batch in batches:
+            yield from batch
+    finally:
+        batches.close()
+
+def group_rows(batches):
+    """
+    Group consecutive rows with the same ORDER_ID into (order_id, items) pairs.
+    The rows are read as iter_row_batches() batches and the grouping of each
+    batch is timed as "group_orders"; the orders a batch completes are
+    yielded after it, so the timer does not include the consumer.
+    """
+    current_id = None
+    items = []
+    for batch in batches:
+        with timer("group_orders"):
+            completed = []
+            for row in batch:
+                order_id = row['ORDER_ID']
+                if items and order_id != current_id:
+                    completed.append((current_id, items))
+                    items = []
+                current_id = order_id
+                items.append(row)
+        yield from completed
+
+    if items:
+        yield current_id, items
+
+def merge_headers_and_lines(headers, lines):
+    """
+    Merge ORDER_ID-ordered headers and line batches into (order_id, items) groups.
+    Each OrderLine gets a reference to its OrderHeader, so the header is
+    shared by all lines of the order instead of copied.
+    Orders without lines, and lines without a header, are skipped.
+    """
+    line_groups = group_rows(lines)
+    pending = next(line_groups, None)
+    for header in headers:
+        order_id = header['ORDER_ID']
+        # Ohita rivit, joiden otsikko puuttuu (esim. lisätty kyselyiden välissä)
+        while pending is not None and pending[0] < order_id:
+            pending = next(line_groups, None)
+        if pending is None:
+            break
+        if pending[0] == order_id:
+            for line in pending[1]:
+                line.header = header
+            yield order_id, pending[1]
+            pending = next(line_groups, None)
+
+def iter_order_groups(min_order_id=None, max_order_id=None, normalized=False,
+                      batch_size=FETCH_BATCH_SIZE, show_query=False, by_customer=False):
+    """
+    Yield (order_id, items) groups for the orders in (min_order_id, max_order_id].
+    With by_customer the orders are ordered by CUSTOMER_ID first.
+    Database errors are raised to the caller.
+    """
+    if normalized and by_customer:
+        raise ValueError("by_customer is not supported with normalized fetching")
+    if normalized:
+        header_query, line_query, params = build_normalized_queries(min_order_id, max_order_id)
+        if show_query:
+            print("\n✅ Käytetään normalisoitua hakua (otsikot ja rivit erikseen)")
+            log.debug(header_query)
+            log.debug(line_query)
+
+        if max_order_id is not None:
+            # Rajatun sivun otsikot luetaan ensin, jotta sivu varaa vain yhden yhteyden kerrallaan
+            headers = iter(list(iter_rows(header_query, params, batch_size, row_factory=header_row_factory)))
+        else:
+            headers = iter_rows(header_query, params, batch_size, row_factory=header_row_factory)
+        lines = iter_row_batches(line_query, params, batch_size)
+        try:
+            yield from merge_headers_and_lines(headers, lines)
+        finally:
+            if hasattr(headers, "close"):
+                headers.close()
+            lines.close()
+        return
+
+    # Lue generoitu SQL-kysely tiedostosta
+    sql_query, params = build_invoice_query(min_order_id, max_order_id, by_customer)
+    if show_query:
+        print("\n✅ Käytetään generoitua kyselyä")
+        log.debug(sql_query)
+
+    # Ryhmittele peräkkäiset rivit ORDER_ID:n mukaan
+    rows = iter_row_batches(sql_query, params, batch_size)
+    try:
+        yield from group_rows(rows)
+    finally:
+        rows.close()
+
+def order_id_source(sql_query):
+    """
+    Return the (table, column) that the ORDER_ID of the generated query is
+    selected from, i.e. the main table of the FROM clause, or None if the
+    query does not have that shape.
+    """
+    select = re.search(r"(\[[^\]]+\]|\w+)\.(\[[^\]]+\]|\w+)\s+AS\s+ORDER_ID\b", sql_query, re.IGNORECASE)
+    source = re.search(r"^FROM\s+(\S+)\s+AS\s+(\S+)\s*$", sql_query, re.IGNORECASE | re.MULTILINE)
+    if not select or not source or select.group(1) != source.group(2):
+        return None
+    return source.group(1), select.group(2)
+
+def fetch_page_bounds(min_order_id=None, page_size=PAGE_SIZE, max_order_id=None):
+    """
+    Return the last ORDER_ID of every full page of page_size orders, in order.
+    The pages are (previous bound, bound] ranges; the orders after the last
+    bound form one more, open-ended page.
+    The bounds are read from the order ID column of the main table alone, so
+    the server does not run the joins of the invoice query for them. Orders
+    without lines just make a page smaller.
+    """
+    sql_query = read_invoice_query()
+    source = order_id_source(sql_query)
+    if source is not None:
+        table, column = source
+        where, params = order_id_filter(min_order_id, max_order_id, column=f"order_ids.{column}")
+        query = f"""SELECT order_pages.ORDER_ID
+FROM (
+    SELECT order_ids.{column} AS ORDER_ID, ROW_NUMBER() OVER (ORDER BY order_ids.{column}) AS PAGE_ROW
+    FROM {table} AS order_ids
+    {where}
+) AS order_pages
+WHERE order_pages.PAGE_ROW %% %s = 0
+ORDER BY order_pages.ORDER_ID;"""
+        return page_bounds(query, params, page_size)
+
+    # Muun muotoisesta kyselystä rajat haetaan koko kyselyn tuloksesta
+    inner_query = strip_order_by(sql_query)
+    where, params = order_id_filter(min_order_id, max_order_id)
+    query = f"""SELECT order_pages.ORDER_ID
+FROM (
+    SELECT order_ids.ORDER_ID, ROW_NUMBER() OVER (ORDER BY order_ids.ORDER_ID) AS PAGE_ROW
+    FROM (
+        SELECT DISTINCT invoice_rows.ORDER_ID
+        FROM (
+{inner_query}
+        ) AS invoice_rows
+        {where}
+    ) AS order_ids
+) AS order_pages
+WHERE order_pages.PAGE_ROW %% %s = 0
+ORDER BY order_pages.ORDER_ID;"""
+    return page_bounds(query, params, page_size)
+
+def page_bounds(query, params, page_size):
+    rows = fetch_data(query, (params or ()) + (page_size,))
+    if rows is None:
+        raise RuntimeError("Sivujen rajoja ei voitu hakea")
+    return [row['ORDER_ID'] for row in rows]
+
+def iter_orders_in_pages(min_order_id=None, normalized=False, batch_size=FETCH_BATCH_SIZE,
+                         workers=FETCH_WORKERS, page_size=PAGE_SIZE, max_order_id=None):
+    """
+    Fetch the orders as keyset pages of page_size orders over several pooled
+    connections at once. Every page is an ORDER_ID range, so the lines of an
+    order always stay together, and the pages are yielded in order. At most
+    2 * workers pages are fetched ahead of the consumer.
+    """
+    bounds = fetch_page_bounds(min_order_id, page_size, max_order_id)
+    pages = list(zip([min_order_id] + bounds, bounds + [max_order_id]))
+    print(f"📑 Haetaan {len(pages)} sivua ({page_size} tilausta/sivu) {workers} yhteydellä")
+
+    def fetch_page(lower, upper):
+        return list(iter_order_groups(lower, upper, normalized, batch_size))
+
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="order-fetch") as executor:
+        try:
+            for lower, upper in pages:
+                in_flight.append(executor.submit(fetch_page, lower, upper))
+                if len(in_flight) >= workers * 2:
+                    yield from in_flight.popleft().result()
+            while in_flight:
+                yield from in_flight.popleft().result()
+        finally:
+            # Kesken jätetyn haun odottavia sivuja ei enää haeta
+            for future in in_flight:
+                future.cancel()
+
+def iter_orders_by_invoice(batch_size=FETCH_BATCH_SIZE, min_order_id=None, normalized=False,
+                           fetch_workers=1, max_order_id=None, by_customer=False):
+    """
+    Stream order details from the database one order at a time.
+    Rows are read in fetchmany() batches and, because the generated query is
+    ordered by SalesOrderID, yielded as (order_id, items) groups as soon as
+    the next order starts. Memory use stays at the size of the largest order.
+    Items are compact OrderLine rows that share one OrderHeader per order.
+    With min_order_id only orders after that ID are fetched, and with
+    max_order_id only orders up to and including it.
+    With normalized the headers and lines are fetched as two result sets on
+    separate pooled connections and merged here, so the customer and due
+    date columns are transferred once per order instead of once per line.
+    With fetch_workers > 1 the orders are fetched as keyset pages in parallel.
+    With by_customer the orders are ordered by CUSTOMER_ID, then ORDER_ID, so
+    the order IDs are not ascending (single query only).
+    Errors are printed and raised, so a stream that ended early is not
+    taken for a complete one.
+    """
+    try:
+        if by_customer and (normalized or fetch_workers > 1):
+            raise ValueError("Asiakasjärjestys toimii vain yhdellä kyselyllä")
+        if fetch_workers > 1:
+            if normalized:
+                print("\n✅ Käytetään normalisoitua hakua (otsikot ja rivit erikseen)")
+            yield from iter_orders_in_pages(min_order_id, normalized, batch_size, workers=fetch_workers,
+                                            max_order_id=max_order_id)
+        else:
+            yield from iter_order_groups(min_order_id, max_order_id, normalized=normalized,
+                                         batch_size=batch_size, show_query=True, by_customer=by_customer)
 
     except pymssql.Error as e:
         print(f"⚠️ Tietokantavirhe: {e}")
-        return None
+        raise
     except Exception as e:
         print(f"⚠️ Odottamaton virhe: {e}")
+        raise
+
+def iter_statements_by_customer(batch_size=FETCH_BATCH_SIZE, min_order_id=None, max_order_id=None):
+    """
+    Stream the orders grouped per customer for consolidated statements.
+    The rows are fetched ordered by CUSTOMER_ID and ORDER_ID and yielded as
+    (customer_id, [(order_id, items), ...]) groups, so memory use stays at
+    the size of the largest customer.
+    With min_order_id only orders after that ID are included, and with
+    max_order_id only orders up to and including it.
+    Errors are printed and raised: the stream is ordered by customer, so a
+    stream that ended early must not be taken for a complete one.
+    """
+    try:
+        sql_query, params = build_invoice_query(min_order_id, max_order_id, by_customer=True)
+
+        print("\n✅ Käytetään asiakaskohtaista kyselyä")
+        log.debug(sql_query)
+
+        rows = iter_row_batches(sql_query, params, batch_size)
+        try:
+            current_id = None
+            orders = []
+            for order_id, items in group_rows(rows):
+                customer_id = items[0].get('CUSTOMER_ID')
+                if orders and customer_id != current_id:
+                    yield current_id, orders
+                    orders = []
+                current_id = customer_id
+                orders.append((order_id, items))
+
+            if orders:
+                yield current_id, orders
+        finally:
+            rows.close()
+
+    except pymssql.Error as e:
+        print(f"⚠️ Tietokantavirhe: {e}")
+        raise
+    except Exception as e:
+        print(f"⚠️ Odottamaton virhe: {e}")
+        raise
+
+def group_orders_by_invoice():
+    """
+    Fetch and group order details from database using the generated query.
+    """
+    grouped_orders = dict(iter_orders_by_invoice())
+
+    if not grouped_orders:
+        print("⚠️ Tilauksia ei löytynyt.")
         return None
+
+    return grouped_orders
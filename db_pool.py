@@ -0,0 +1,166 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+import pymssql
+from config import load_config
+
+# Yhteyspoolin asetukset
+POOL_SIZE = 4  # Enimmäismäärä samanaikaisia yhteyksiä
+IDLE_TIMEOUT = 300  # Sekuntia, jonka jälkeen käyttämätön yhteys suljetaan
+HEALTH_CHECK_AFTER = 30  # Sekuntia, jonka jälkeen yhteys tarkistetaan ennen uudelleenkäyttöä
+LOGIN_TIMEOUT = 10
+
+def connect():
+    """
+    Open a new connection to the Azure SQL database using the loaded settings.
+    """
+    config = load_config()
+    if not config:
+        raise Exception("Asetukset puuttuvat!")
+
+    server = config["DB_SERVER"]
+    return pymssql.connect(
+        server=server,
+        user=f"{config['DB_USER']}@{server.split('.')[0]}",
+        password=config["DB_PASSWORD"],
+        database=config["DB_NAME"],
+        login_timeout=LOGIN_TIMEOUT,
+        autocommit=True  # Vain lukukyselyitä, ei avoimia transaktioita pooliin
+    )
+
+class ConnectionPool:
+    """
+    A bounded pool of database connections.
+    Idle connections are evicted after idle_timeout seconds and checked with
+    SELECT 1 before reuse if they have been idle for more than
+    health_check_after seconds.
+    """
+
+    def __init__(self, factory=connect, max_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT,
+                 health_check_after=HEALTH_CHECK_AFTER):
+        self._factory = factory
+        self._idle_timeout = idle_timeout
+        self._health_check_after = health_check_after
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return an idle healthy connection, or open a new one. Blocks while the pool is full."""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    return self._factory()
+
+                conn, last_used = entry
+                idle_for = time.monotonic() - last_used
+                if idle_for > self._idle_timeout:
+                    self._close(conn)
+                elif idle_for <= self._health_check_after or self._is_healthy(conn):
+                    return conn
+                else:
+                    self._close(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool, or close it if discard is set."""
+        try:
+            if discard:
+                self._close(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+                self._evict_idle()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that borrows a connection from the pool."""
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except (pymssql.InterfaceError, pymssql.OperationalError):
+            # Yhteys voi olla rikki, joten sitä ei palauteta pooliin
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close_all(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [conn for conn, last_used in self._idle if now - last_used > self._idle_timeout]
+            self._idle = [(conn, last_used) for conn, last_used in self._idle
+                          if now - last_used <= self._idle_timeout]
+        for conn in expired:
+            self._close(conn)
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the shared connection pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+            atexit.register(_pool.close_all)
+        return _pool
+
+def configure_pool(factory=connect, **options):
+    """
+    Replace the shared pool, e.g. with a different connection factory.
+    Idle connections of the previous pool are closed.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+        _pool = ConnectionPool(factory, **options)
+        atexit.register(_pool.close_all)
+        return _pool
+
+@contextmanager
+def get_connection():
+    """
+    Borrow a connection from the shared pool.
+    """
+    with get_pool().connection() as conn:
+        yield conn
+
+def close_pool():
+    """Close all idle connections of the shared pool."""
+    if _pool is not None:
+        _pool.close_all()
@@ -0,0 +1,116 @@
+import gzip
+import json
+import logging
+import os
+from contextlib import ExitStack
+from datetime import datetime
+from lxml import etree
+from metrics import count
+from invoice_generator import sanitize_filename, write_invoice_element, xml_header_fields
+
+log = logging.getLogger(__name__)
+
+# Kuinka monta laskua kirjoitetaan yhteen <Invoices>-dokumenttiin
+XML_BATCH_SIZE = 1000
+BATCH_DIRECTORY = "invoices"
+
+class _CountingWriter:
+    """Pass writes through to a file object and count the uncompressed bytes."""
+
+    def __init__(self, target):
+        self.target = target
+        self.offset = 0
+
+    def write(self, data):
+        self.offset += len(data)
+        return self.target.write(data)
+
+class XmlBatchWriter:
+    """
+    Write many invoices into streamed <Invoices> documents.
+    A document is finished after batch_size invoices or, with per_customer,
+    when the next invoice belongs to another customer; per_customer expects
+    an order stream ordered by customer (see iter_orders_by_invoice()). With compress the
+    documents are gzip-compressed. Every document gets an index file
+    <document>.index.json that maps each order ID to the [offset, length]
+    of its <Invoice> element in the uncompressed document.
+    """
+
+    def __init__(self, batch_size=XML_BATCH_SIZE, per_customer=False, compress=False,
+                 directory=BATCH_DIRECTORY):
+        self.batch_size = batch_size
+        self.per_customer = per_customer
+        self.compress = compress
+        self.directory = directory
+        self.path = None
+        self._run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+        self._sequence = 0
+        self._stack = None
+
+    def add(self, order_id, customer_name, billable_company, due_date, items, totals):
+        """
+        Append one invoice to the current document.
+        Returns the (document, index) pairs finished by this call, if any.
+        """
+        customer = items[0].get("CUSTOMER_ID", customer_name) if items else customer_name
+        finished = []
+        if self._stack is not None and (
+            len(self._offsets) >= self.batch_size
+            or (self.per_customer and customer != self._customer)
+        ):
+            finished.append(self._finish())
+        if self._stack is None:
+            self._open(customer)
+
+        header = xml_header_fields(order_id, customer_name, billable_company, due_date)
+        self._xf.write("\n  ")
+        self._xf.flush()
+        start = self._counter.offset
+        write_invoice_element(self._xf, header, items, totals, level=1)
+        self._xf.flush()
+        self._offsets[str(order_id)] = [start, self._counter.offset - start]
+        return finished
+
+    def close(self):
+        """Finish the current document. Returns the finished (document, index) pairs."""
+        return [self._finish()] if self._stack is not None else []
+
+    def _open(self, customer):
+        self._sequence += 1
+        name = f"invoices_{self._run_id}_{self._sequence:04d}"
+        if self.per_customer:
+            name = f"invoices_{sanitize_filename(str(customer))}_{self._run_id}_{self._sequence:04d}"
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, name + (".xml.gz" if self.compress else ".xml"))
+
+        self._stack = ExitStack()
+        output = self._stack.enter_context(open(self.path, "wb"))
+        if self.compress:
+            output = self._stack.enter_context(gzip.GzipFile(fileobj=output, mode="wb"))
+        self._counter = _CountingWriter(output)
+        # pretty_print päättää dokumentin rivinvaihtoon juurielementin jälkeen;
+        # ExitStack sulkee kontekstit käänteisessä järjestyksessä
+        self._stack.callback(self._counter.write, b"\n")
+        self._xf = self._stack.enter_context(etree.xmlfile(self._counter, encoding="UTF-8"))
+        self._xf.write_declaration()
+        self._stack.enter_context(self._xf.element("Invoices"))
+        self._customer = customer
+        self._offsets = {}
+
+    def _finish(self):
+        self._xf.write("\n")
+        self._stack.close()
+        count("bytes_written", os.path.getsize(self.path))
+
+        index_path = f"{self.path}.index.json"
+        with open(index_path, "w") as f:
+            json.dump({
+                "document": os.path.basename(self.path),
+                "compression": "gzip" if self.compress else None,
+                "offsets": "uncompressed",
+                "invoices": self._offsets
+            }, f, indent=2)
+        log.info(f"✅ Generated XML batch: {self.path} ({len(self._offsets)} invoices)")
+
+        self._stack = None
+        return self.path, index_path
@@ -2,149 +2,501 @@ from lxml import etree
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib import colors
-from reportlab.platypus import Table, TableStyle
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+import io
+import logging
 import os
-from db_handler import group_orders_by_invoice
+from collections import deque
+from xml.sax.saxutils import escape
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from db_handler import iter_orders_by_invoice
+from blob_handler import InMemoryFile
+from invoice_manifest import load_manifest, save_manifest, invoice_hash, is_unchanged, record_invoice
+from invoice_totals import compute_totals
+from metrics import call_measured, count, timed, unpack_measured
 from datetime import datetime
 
+log = logging.getLogger(__name__)
+
+# Bump when the XML or PDF layout changes so cached invoices are re-rendered.
+RENDERER_VERSION = "2"
+
+# Laskut, joissa on vähintään näin monta riviä, kirjoitetaan XML:ksi virtana
+XML_STREAMING_MIN_LINES = 1000
+
+# PDF-laskupohja: taulukon tyyli ja sarakeleveydet rakennetaan kerran
+INVOICE_TABLE_HEADER = ["Product", "Qty", "Price (€)", "Amount (€)"]
+INVOICE_TABLE_COL_WIDTHS = [250, 50, 80, 80]
+_TABLE_COMMANDS = [
+    ("BACKGROUND", (0, 0), (-1, 0), colors.grey),
+    ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+    ("ALIGN", (1, 1), (-1, -1), "CENTER"),
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.black),
+    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+    ("BOTTOMPADDING", (0, 0), (-1, 0), 5),
+    ("TOPPADDING", (0, 0), (-1, 0), 5),
+]
+_TOTAL_ROW_COMMANDS = [
+    ("BACKGROUND", (0, -1), (-1, -1), colors.lightgrey),
+    ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
+]
+INVOICE_TABLE_STYLE = TableStyle(_TABLE_COMMANDS + _TOTAL_ROW_COMMANDS)
+# Monisivuisen laskun välisivut: ei loppusummarivin korostusta
+INVOICE_PAGE_STYLE = TableStyle(_TABLE_COMMANDS)
+STATIC_LAYER_FORM = "InvoiceStaticLayer"
+
+# Yhdelle sivulle piirrettävän laskun enimmäisrivimäärä; pidemmät sivutetaan
+PDF_SINGLE_PAGE_MAX_LINES = 28
+PDF_MARGINS = dict(leftMargin=50, rightMargin=50, topMargin=200, bottomMargin=40)
+
+# Asiakaskohtaisen koosteen tilausotsikot ja loppusummarivi
+STATEMENT_SECTION_STYLE = getSampleStyleSheet()["Heading4"]
+STATEMENT_TOTAL_STYLE = TableStyle([
+    ("ALIGN", (1, 0), (-1, -1), "CENTER"),
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.black),
+    ("BACKGROUND", (0, 0), (-1, -1), colors.lightgrey),
+    ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"),
+])
+
 def sanitize_filename(value):
     """Sanitize filenames by replacing spaces and invalid characters."""
     return value.replace(" ", "_").replace("/", "_").replace("\\", "_").strip()
 
-def generate_invoice_files():
+def prepare_invoice(order_id, items):
     """
-    Generate XML and PDF invoice files for each order.
-    Asks for the number of customer invoices to generate.
-    Skipped orders (due to missing details) do not count toward the total.
+    Resolve the customer details and output file names for an order.
+    Returns the arguments for render_invoice(), or None if the order is skipped.
     """
-    orders = group_orders_by_invoice()
-    
-    # Debug: Check what orders look like
-    if not orders:
-        print("⚠️ No orders found for invoice generation.")
+    # Check that there is at least one item in the order
+    if not items:
+        log.debug(f"Skipping order {order_id} because it contains no items.")
         return None
-    else:
-        print(f"DEBUG: Found {len(orders)} order(s) for invoice generation.")
-        for order_id, items in orders.items():
-            print(f"DEBUG: Order ID: {order_id} - First item keys: {list(items[0].keys()) if items else 'No items'}")
 
-    invoice_files = []
+    # Extract required fields using the correct keys.
+    customer_name = items[0].get("CUSTOMER_NAME", "Unknown")
+    billable_company = customer_name if customer_name != "Unknown" else "NoCompany"
+    due_date = items[0].get("DUE_DATE", "Unknown")  # Extract due date
 
-    # Ask user for the number of customer invoices to generate.
-    target_count = None
-    target_input = input("Enter number of customer invoices to generate (or press Enter for all): ").strip()
-    if target_input:
-        try:
-            target_count = int(target_input)
-            if target_count <= 0:
-                print("Number must be positive. Invoices will be generated for all customers.")
-                target_count = None
-        except ValueError:
-            print("Invalid number entered. Invoices will be generated for all customers.")
+    # Debug: Show extracted values
+    log.debug(f"Order {order_id} - Customer: '{customer_name}', Due Date: '{due_date}'")
 
-    successful_count = 0  # Count of successfully generated invoices
+    # Sanitize fields for filenames
+    customer_filename = sanitize_filename(customer_name)
+    billable_company_sanitized = sanitize_filename(billable_company)
 
-    for order_id, items in orders.items():
-        # Check that there is at least one item in the order
-        if not items:
-            print(f"DEBUG: Skipping order {order_id} because it contains no items.")
-            continue
+    # Ensure valid filename and required customer details.
+    if customer_filename == "Unknown" or billable_company_sanitized == "NoCompany":
+        log.warning(f"⚠️ Skipping invoice for order {order_id}: Missing customer details (customer_name='{customer_name}')")
+        return None
 
-        # Extract required fields using the correct keys.
-        customer_name = items[0].get("CUSTOMER_NAME", "Unknown")
-        billable_company = customer_name if customer_name != "Unknown" else "NoCompany"
-        due_date = items[0].get("DUE_DATE", "Unknown")  # Extract due date
+    # Generate file names
+    base_filename = f"{customer_filename}_{billable_company_sanitized}_Invoice_{order_id}"
+    xml_file = f"invoices/{base_filename}.xml"
+    pdf_file = f"invoices/{base_filename}.pdf"
 
-        # Debug: Show extracted values
-        print(f"DEBUG: Order {order_id} - Customer: '{customer_name}', Due Date: '{due_date}'")
+    return order_id, customer_name, billable_company, due_date, items, xml_file, pdf_file
 
-        # Sanitize fields for filenames
-        customer_filename = sanitize_filename(customer_name)
-        billable_company_sanitized = sanitize_filename(billable_company)
+@timed("render_invoice")
+def render_invoice(order_id, customer_name, billable_company, due_date, items, xml_file, pdf_file,
+                   in_memory=False, xml=True, totals=None):
+    """
+    Render the XML and PDF files of one invoice.
+    With in_memory the files are rendered into buffers and returned as
+    InMemoryFile objects instead of being written to the invoices directory.
+    Without xml only the PDF is rendered and a one-file tuple is returned.
+    The totals are computed once (unless given) and shared by both renderers.
+    Module-level so that it can be run in a worker process.
+    """
+    if totals is None:
+        totals = compute_totals(items)
+    outputs = ((xml_file, generate_xml), (pdf_file, generate_pdf)) if xml else ((pdf_file, generate_pdf),)
+    return write_outputs(outputs, (order_id, customer_name, billable_company, due_date, items), totals,
+                         in_memory)
 
-        # Ensure valid filename and required customer details.
-        if customer_filename == "Unknown" or billable_company_sanitized == "NoCompany":
-            print(f"⚠️ Skipping invoice for order {order_id}: Missing customer details (customer_name='{customer_name}')")
-            continue
+def write_outputs(outputs, args, totals, in_memory=False):
+    """
+    Call each generate(*args, filename, totals) of the (filename, generate)
+    pairs and return the files, as InMemoryFile objects with in_memory.
+    """
+    if in_memory:
+        artifacts = []
+        for filename, generate in outputs:
+            buffer = io.BytesIO()
+            buffer.name = os.path.basename(filename)
+            generate(*args, buffer, totals)
+            artifacts.append(InMemoryFile(buffer.name, buffer.getvalue()))
+            count("bytes_written", len(artifacts[-1].data))
+        return tuple(artifacts)
+
+    # Ensure invoice directory exists
+    os.makedirs("invoices", exist_ok=True)
+
+    for filename, generate in outputs:
+        generate(*args, filename, totals)
+        count("bytes_written", os.path.getsize(filename))
+    return tuple(filename for filename, _ in outputs)
+
+def prepare_statement(customer_id, orders):
+    """
+    Resolve the customer details and output file names for a consolidated
+    statement of one customer's orders. The file names carry the order ID
+    range, so every run's statement is a new object.
+    Returns the arguments for render_statement(), or None if the statement is skipped.
+    """
+    orders = [(order_id, items) for order_id, items in orders if items]
+    if not orders:
+        log.debug(f"Skipping statement for customer {customer_id} because it contains no orders.")
+        return None
 
-        # Generate file names
-        base_filename = f"{customer_filename}_{billable_company_sanitized}_Invoice_{order_id}"
-        xml_file = f"invoices/{base_filename}.xml"
-        pdf_file = f"invoices/{base_filename}.pdf"
+    customer_name = orders[0][1][0].get("CUSTOMER_NAME", "Unknown")
+    billable_company = customer_name if customer_name != "Unknown" else "NoCompany"
+    log.debug(f"Statement for customer {customer_id} - Customer: '{customer_name}', Orders: {len(orders)}")
 
-        # Ensure invoice directory exists
-        os.makedirs("invoices", exist_ok=True)
+    customer_filename = sanitize_filename(customer_name)
+    billable_company_sanitized = sanitize_filename(billable_company)
+    if customer_filename == "Unknown" or billable_company_sanitized == "NoCompany":
+        log.warning(f"⚠️ Skipping statement for customer {customer_id}: Missing customer details (customer_name='{customer_name}')")
+        return None
 
-        # Generate XML and PDF invoice files.
+    # Inkrementaalisen ajon kooste sisältää vain uudet tilaukset, joten tilausväli
+    # nimessä estää aiemman koosteen ylikirjoittamisen
+    order_range = f"{orders[0][0]}-{orders[-1][0]}"
+    base_filename = f"{customer_filename}_{billable_company_sanitized}_Statement_{customer_id}_{order_range}"
+    xml_file = f"invoices/{base_filename}.xml"
+    pdf_file = f"invoices/{base_filename}.pdf"
+
+    # Manifestin avain ei saa törmätä tilausnumeroihin
+    statement_key = f"customer-{customer_id}-{order_range}"
+    return statement_key, customer_id, customer_name, billable_company, orders, xml_file, pdf_file
+
+def statement_hash(statement_key, customer_id, customer_name, billable_company, orders, *_files):
+    """Hash the inputs of a statement like invoice_hash() does for one invoice."""
+    return invoice_hash(RENDERER_VERSION, statement_key, customer_name, billable_company,
+                        [(order_id, items[0].get("DUE_DATE")) for order_id, items in orders],
+                        [item for _order_id, items in orders for item in items])
+
+@timed("render_invoice")
+def render_statement(statement_key, customer_id, customer_name, billable_company, orders, xml_file, pdf_file,
+                     in_memory=False):
+    """
+    Render the XML and PDF files of one customer statement.
+    The totals of every order are computed once and shared by both renderers.
+    Module-level so that it can be run in a worker process.
+    """
+    totals = [compute_totals(items) for _order_id, items in orders]
+    outputs = ((xml_file, generate_statement_xml), (pdf_file, generate_statement_pdf))
+    return write_outputs(outputs, (customer_id, customer_name, billable_company, orders), totals, in_memory)
+
+def iter_invoice_files(orders, workers=1, use_cache=True, target_count=None, stats=None, in_memory=False,
+                       xml_batch=None, statements=False, dry_run=False):
+    """
+    Generate invoices for a stream of (order_id, items) groups and yield the
+    (xml_file, pdf_file) pair of each invoice as soon as it is ready, in the
+    order of the input stream. Stops after target_count successful invoices.
+    With in_memory the pair holds InMemoryFile objects instead of paths.
+    With workers > 1 the invoices are rendered in a process pool.
+    With use_cache, orders whose inputs hash the same as in the manifest of
+    the previous run are skipped.
+    With xml_batch (an invoice_batch.XmlBatchWriter) the XML of each invoice
+    is appended to batch documents in stream order: the PDF is yielded as a
+    one-file tuple and each finished batch as a (document, index) pair.
+    With statements the stream holds (customer_id, [(order_id, items), ...])
+    groups and one consolidated statement is rendered per customer.
+    With dry_run nothing is rendered or recorded in the manifest; the
+    invoices that would be generated are only logged and counted.
+    Counters are stored in stats if a dict is given; stats["lowest_failed_order"]
+    is the lowest order ID (or statement key) whose invoice could not be generated.
+    """
+    if statements and xml_batch is not None:
+        raise ValueError("XML batches are not supported for customer statements")
+    orders = iter(orders)
+    if stats is None:
+        stats = {}
+    stats.update(orders=0, generated=0, unchanged=0, failed=0, lowest_failed_order=None)
+    manifest = load_manifest()
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    pending = deque()  # (job, digest, totals, future) in submission order
+
+    def record_failure(order_id):
+        stats["failed"] += 1
+        if stats["lowest_failed_order"] is None or order_id < stats["lowest_failed_order"]:
+            stats["lowest_failed_order"] = order_id
+
+    def collect(job, digest, totals, render):
+        """
+        Wait for one invoice and record it; per-order failures do not abort the batch.
+        Returns the file tuples to yield.
+        """
+        order_id = job[0]  # Tilausnumero tai koosteen avain
         try:
-            generate_xml(order_id, customer_name, billable_company, due_date, items, xml_file)
-            generate_pdf(order_id, customer_name, billable_company, due_date, items, pdf_file)
+            files = render()
         except Exception as e:
-            print(f"⚠️ Error generating invoice for order {order_id}: {e}")
-            continue
-
-        # Append generated files to the list and count the successful creation.
-        invoice_files.append((xml_file, pdf_file))
-        successful_count += 1
-        print(f"DEBUG: Successfully generated invoice for order {order_id}.")
-
-        # If a target count was provided and reached, stop processing further orders.
-        if target_count is not None and successful_count >= target_count:
-            print(f"Reached target of {target_count} customer invoices.")
-            break
+            log.warning(f"⚠️ Error generating invoice for order {order_id}: {e}")
+            record_failure(order_id)
+            return []
+
+        results = [files]
+        if xml_batch is not None:
+            try:
+                results += xml_batch.add(*job[:5], totals)
+            except Exception as e:
+                log.warning(f"⚠️ Error adding order {order_id} to the XML batch: {e}")
+                record_failure(order_id)
+                return results
+            files = files + (xml_batch.path,)
+
+        # Record the generated files and count the successful creation.
+        record_invoice(manifest, order_id, digest, files)
+        stats["generated"] += 1
+        count("invoices_generated")
+        log.debug(f"Successfully generated invoice for order {order_id}.")
+        return results
+
+    try:
+        for group_id, items in orders:
+            stats["orders"] += 1
+
+            if statements:
+                job = prepare_statement(group_id, items)
+                if job is None:
+                    continue
+                digest = statement_hash(*job)
+                render, totals, options = render_statement, None, dict(in_memory=in_memory)
+            else:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f"Order ID: {group_id} - First item keys: {list(items[0].keys()) if items else 'No items'}")
+                job = prepare_invoice(group_id, items)
+                if job is None:
+                    continue
+                digest = invoice_hash(RENDERER_VERSION, *job[:5])
+
+                # Batch XML is written here in stream order, so its totals are computed here too.
+                totals = compute_totals(items) if xml_batch is not None else None
+                render, options = render_invoice, dict(in_memory=in_memory, xml=xml_batch is None, totals=totals)
+
+            # Skip orders whose invoice inputs have not changed since the last run.
+            if use_cache and is_unchanged(manifest, job[0], digest):
+                log.debug(f"Skipping order {job[0]}: invoice is unchanged.")
+                stats["unchanged"] += 1
+                continue
+
+            # Generate XML and PDF invoice files.
+            if dry_run:
+                log.info(f"🧪 Would generate: {', '.join(job[-2:])}")
+                stats["generated"] += 1
+            elif executor is None:
+                yield from collect(job, digest, totals, lambda: render(*job, **options))
+            else:
+                # Työprosessin mittaukset palautetaan tuloksen mukana
+                pending.append((job, digest, totals, executor.submit(call_measured, render, *job, **options)))
+                # Keep a bounded window of orders in flight, and never more
+                # than the invoices still needed to reach the target.
+                while pending and (
+                    len(pending) >= workers * 2
+                    or (target_count is not None and stats["generated"] + len(pending) >= target_count)
+                ):
+                    pending_job, pending_digest, pending_totals, future = pending.popleft()
+                    yield from collect(pending_job, pending_digest, pending_totals,
+                                      lambda: unpack_measured(future.result()))
+
+            # If a target count was provided and reached, stop processing further orders.
+            if target_count is not None and stats["generated"] >= target_count:
+                log.info(f"Reached target of {target_count} customer invoices.")
+                break
+
+        # Wait for the remaining invoices in submission order.
+        while pending:
+            pending_job, pending_digest, pending_totals, future = pending.popleft()
+            yield from collect(pending_job, pending_digest, pending_totals,
+                              lambda: unpack_measured(future.result()))
+
+        # Finish the last XML batch document.
+        if xml_batch is not None:
+            yield from xml_batch.close()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if xml_batch is not None:
+            xml_batch.close()
+        if not dry_run:
+            save_manifest(manifest)
+        # Stop the database stream if the target was reached before the last order.
+        if hasattr(orders, "close"):
+            orders.close()
+
+def generate_invoice_files(orders=None, workers=1, use_cache=True, in_memory=False, xml_batch=None,
+                           statements=False, target_count=None, stats=None):
+    """
+    Generate XML and PDF invoice files for each order.
+    Orders are an iterable of (order_id, items) groups, e.g. the stream from
+    iter_orders_by_invoice(); if not given, the stream is fetched here.
+    With workers > 1 the invoices are rendered in a process pool; the
+    returned list keeps the order of the input stream.
+    With use_cache, orders whose inputs hash the same as in the manifest of
+    the previous run are skipped and not returned.
+    With in_memory nothing is written to the invoices directory; the list
+    holds InMemoryFile pairs for upload_files_to_blob().
+    With xml_batch the XML is written into batch documents (see iter_invoice_files()).
+    With statements the orders are per-customer groups and one statement is
+    generated per customer.
+    Stops after target_count invoices if it is given.
+    Counters are stored in stats if a dict is given (see iter_invoice_files()).
+    Skipped orders (due to missing details or unchanged inputs) do not count toward the total.
+    """
+    # Orders are consumed one (order_id, items) group at a time.
+    if orders is None:
+        orders = iter_orders_by_invoice()
+    elif isinstance(orders, dict):
+        orders = orders.items()
+
+    if stats is None:
+        stats = {}
+    invoice_files = list(iter_invoice_files(orders, workers, use_cache, target_count, stats, in_memory,
+                                            xml_batch, statements))
+
+    if stats["orders"] == 0:
+        log.warning("⚠️ No orders found for invoice generation.")
+        return None
 
-    print(f"DEBUG: Generated {successful_count} invoice(s) in total.")
+    log.info(f"Processed {stats['orders']} order(s) for invoice generation.")
+    if stats["unchanged"]:
+        log.info(f"Skipped {stats['unchanged']} unchanged invoice(s).")
+    log.info(f"Generated {stats['generated']} invoice(s) in total.")
     return invoice_files
 
+def xml_item_element(item, total_price):
+    """Build the <Item> element of one invoice line."""
+    item_element = etree.Element("Item")
+    etree.SubElement(item_element, "ProductName").text = str(item.get("PRODUCT_NAME", "Unknown"))
+    etree.SubElement(item_element, "Quantity").text = str(item.get("QUANTITY", 0))
+    etree.SubElement(item_element, "UnitPrice").text = str(item.get("UNIT_PRICE", 0))
+    etree.SubElement(item_element, "TotalPrice").text = str(total_price)
+    return item_element
+
 # XML generation function
-def generate_xml(order_id, customer_name, billable_company, due_date, items, filename):
+@timed("render_xml")
+def generate_xml(order_id, customer_name, billable_company, due_date, items, filename, totals=None,
+                 streaming=None):
     """
     Generate an XML invoice file for a grouped order.
-    Calculates each line's total as quantity * unit_price.
+    The filename may also be a writable binary file object.
+    Line totals are taken from totals (see invoice_totals.compute_totals()),
+    which are computed here if not given.
+    With streaming the <Item> elements are written one at a time with
+    etree.xmlfile instead of building the whole tree first; the output is
+    byte-identical. By default invoices with at least XML_STREAMING_MIN_LINES
+    lines are streamed.
     """
-    creation_date = datetime.today().strftime("%Y-%m-%d")
-    root = etree.Element("Invoice")
-    etree.SubElement(root, "OrderID").text = str(order_id)
-    etree.SubElement(root, "CreationDate").text = creation_date
-    etree.SubElement(root, "CustomerName").text = customer_name
-    etree.SubElement(root, "BillableCompany").text = billable_company
-    etree.SubElement(root, "DueDate").text = str(due_date)
-    items_element = etree.SubElement(root, "Items")
-
-    for item in items:
-        item_element = etree.SubElement(items_element, "Item")
-        etree.SubElement(item_element, "ProductName").text = str(item.get("PRODUCT_NAME", "Unknown"))
-        etree.SubElement(item_element, "Quantity").text = str(item.get("QUANTITY", 0))
-        etree.SubElement(item_element, "UnitPrice").text = str(item.get("UNIT_PRICE", 0))
-        # Calculate total price from quantity * unit_price
-        quantity = item.get("QUANTITY", 0)
-        unit_price = item.get("UNIT_PRICE", 0)
-        try:
-            total_price = quantity * unit_price
-        except Exception:
-            total_price = 0
-        etree.SubElement(item_element, "TotalPrice").text = str(total_price)
+    if totals is None:
+        totals = compute_totals(items)
+    if streaming is None:
+        streaming = len(items) >= XML_STREAMING_MIN_LINES
+
+    header = xml_header_fields(order_id, customer_name, billable_company, due_date)
+
+    if streaming:
+        if hasattr(filename, "write"):
+            write_xml_stream(filename, header, items, totals)
+        else:
+            with open(filename, "wb") as f:
+                write_xml_stream(f, header, items, totals)
+    else:
+        root = etree.Element("Invoice")
+        for tag, text in header:
+            etree.SubElement(root, tag).text = text
+        items_element = etree.SubElement(root, "Items")
 
-    tree = etree.ElementTree(root)
-    tree.write(filename, pretty_print=True, xml_declaration=True, encoding="UTF-8")
-    print(f"✅ Generated XML: {filename}")
+        for item, total_price in zip(items, totals.line_totals):
+            items_element.append(xml_item_element(item, total_price))
 
-# PDF generation function
-def generate_pdf(order_id, customer_name, billable_company, due_date, items, filename):
+        tree = etree.ElementTree(root)
+        tree.write(filename, pretty_print=True, xml_declaration=True, encoding="UTF-8")
+    log.debug(f"✅ Generated XML: {getattr(filename, 'name', filename)}")
+
+def xml_header_fields(order_id, customer_name, billable_company, due_date):
+    """Return the (tag, text) pairs written before <Items> in an <Invoice>."""
+    creation_date = datetime.today().strftime("%Y-%m-%d")
+    return [
+        ("OrderID", str(order_id)),
+        ("CreationDate", creation_date),
+        ("CustomerName", customer_name),
+        ("BillableCompany", billable_company),
+        ("DueDate", str(due_date))
+    ]
+
+def write_invoice_element(xf, header, items, totals, level=0):
     """
-    Generate a well-formatted PDF invoice file for a grouped order.
-    Calculates each line's amount as quantity * unit_price and sums the totals.
+    Write one <Invoice> element to an etree.xmlfile writer, one <Item> at a
+    time. The indentation reproduces pretty_print for an element at the given
+    nesting level.
     """
-    c = canvas.Canvas(filename, pagesize=A4)
-    width, height = A4
+    indent = "\n" + "  " * (level + 1)
+    with xf.element("Invoice"):
+        for tag, text in header:
+            element = etree.Element(tag)
+            element.text = text
+            xf.write(indent)
+            xf.write(element)
+
+        xf.write(indent)
+        if not items:
+            xf.write(etree.Element("Items"))
+        else:
+            with xf.element("Items"):
+                for item, total_price in zip(items, totals.line_totals):
+                    item_element = xml_item_element(item, total_price)
+                    etree.indent(item_element, space="  ", level=level + 2)
+                    xf.write(indent + "  ")
+                    xf.write(item_element)
+                xf.write(indent)
+        xf.write("\n" + "  " * level)
+
+def write_xml_stream(output, header, items, totals):
+    """
+    Write an invoice to a binary file object incrementally.
+    The output is byte-identical to tree.write(pretty_print=True).
+    """
+    with etree.xmlfile(output, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        write_invoice_element(xf, header, items, totals)
+    # pretty_print päättää dokumentin rivinvaihtoon juurielementin jälkeen
+    output.write(b"\n")
 
-    creation_date = datetime.today().strftime("%Y-%m-%d")
+def draw_static_layer(c, reuse=False, title="Invoice"):
+    """
+    Draw the page elements that are the same on every invoice page: the logo
+    placeholder and the titles. With reuse they are recorded once per
+    document as a form XObject that every page only references; a single
+    page is cheaper to draw directly.
+    """
+    if reuse:
+        form_name = f"{STATIC_LAYER_FORM}{title}"
+        if not c.hasForm(form_name):
+            c.beginForm(form_name)
+            _draw_static_elements(c, title)
+            c.endForm()
+        c.doForm(form_name)
+    else:
+        _draw_static_elements(c, title)
 
-    # Header
+def _draw_static_elements(c, title):
+    width, height = A4
     c.setFont("Helvetica-Bold", 16)
     c.drawString(50, height - 50, "[LOGO]")  # Placeholder for logo
     c.setFont("Helvetica-Bold", 12)
-    c.drawString(400, height - 50, "Invoice")
+    c.drawString(400, height - 50, title)
+    c.setFont("Helvetica-Bold", 10)
+    c.drawString(50, height - 130, "Billed to:")
+
+def draw_invoice_header(c, order_id, customer_name, billable_company, due_date, creation_date,
+                        reuse=False):
+    """Draw the static layer and the header fields of one invoice page."""
+    width, height = A4
+    draw_static_layer(c, reuse)
+    c.setFont("Helvetica-Bold", 12)
     c.drawString(400, height - 70, f"Invoice ID: {order_id}")
     c.drawString(400, height - 90, f"Creation Date: {creation_date}")
 
@@ -153,51 +505,207 @@ def generate_pdf(order_id, customer_name, billable_company, due_date, items, fil
     c.drawString(50, height - 100, f"Due Date: {due_date}")
 
     # Customer Information
-    c.setFont("Helvetica-Bold", 10)
-    c.drawString(50, height - 130, "Billed to:")
-    c.setFont("Helvetica", 10)
     c.drawString(50, height - 145, f"{customer_name}")
     c.drawString(50, height - 160, f"{billable_company}")
 
+# PDF generation function
+@timed("render_pdf")
+def generate_pdf(order_id, customer_name, billable_company, due_date, items, filename, totals=None,
+                 paginate=None):
+    """
+    Generate a well-formatted PDF invoice file for a grouped order.
+    The filename may also be a writable binary file object.
+    Line amounts and the invoice total are taken from totals (see
+    invoice_totals.compute_totals()), which are computed here if not given.
+    With paginate the item table is laid out with platypus over as many
+    pages as needed, repeating the page header and the table header. By
+    default orders with more than PDF_SINGLE_PAGE_MAX_LINES lines are paginated.
+    """
+    if totals is None:
+        totals = compute_totals(items)
+    if paginate is None:
+        paginate = len(items) > PDF_SINGLE_PAGE_MAX_LINES
+
+    creation_date = datetime.today().strftime("%Y-%m-%d")
+    header = (order_id, customer_name, billable_company, due_date, creation_date)
+
     # Table of items
-    y_position = height - 200
-    table_data = [["Product", "Qty", "Price (€)", "Amount (€)"]]
-    total_amount = 0
+    table_rows = invoice_table_rows(items, totals)
 
-    for item in items:
+    if paginate:
+        write_pdf_pages(filename, header, table_rows)
+    else:
+        c = canvas.Canvas(filename, pagesize=A4)
+        width, height = A4
+        draw_invoice_header(c, *header)
+
+        y_position = height - 200
+        table_data = [INVOICE_TABLE_HEADER] + table_rows
+        table = Table(table_data, colWidths=INVOICE_TABLE_COL_WIDTHS, style=INVOICE_TABLE_STYLE)
+        table.wrapOn(c, width, height)
+        table.drawOn(c, 50, y_position - (len(table_data) * 20))
+        c.save()
+    log.debug(f"✅ Generated PDF: {getattr(filename, 'name', filename)}")
+
+def invoice_table_rows(items, totals):
+    """Return the item rows and the total row of an invoice table."""
+    table_rows = []
+    for item, line_total in zip(items, totals.line_totals):
         product_name = item.get("PRODUCT_NAME", "Unknown")
         quantity = item.get("QUANTITY", 0)
         unit_price = item.get("UNIT_PRICE", 0)
-        # Calculate total price as quantity * unit_price
-        try:
-            line_total = quantity * unit_price
-        except Exception:
-            line_total = 0
-
-        total_amount += line_total
-        table_data.append([product_name, str(quantity), f"{unit_price:.2f}", f"{line_total:.2f}"])
-
-    table_data.append(["", "", "Total", f"{total_amount:.2f}"])
-
-    table = Table(table_data, colWidths=[250, 50, 80, 80])
-    table.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), colors.grey),
-        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-        ("ALIGN", (1, 1), (-1, -1), "CENTER"),
-        ("GRID", (0, 0), (-1, -1), 0.5, colors.black),
-        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-        ("BOTTOMPADDING", (0, 0), (-1, 0), 5),
-        ("TOPPADDING", (0, 0), (-1, 0), 5),
-        ("BACKGROUND", (0, -1), (-1, -1), colors.lightgrey),
-        ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
-    ]))
-
-    table.wrapOn(c, width, height)
-    table.drawOn(c, 50, y_position - (len(table_data) * 20))
-
-    c.save()
-    print(f"✅ Generated PDF: {filename}")
+        table_rows.append([product_name, str(quantity), f"{unit_price:.2f}", f"{line_total:.2f}"])
+
+    table_rows.append(["", "", "Total", f"{totals.total:.2f}"])
+    return table_rows
+
+def invoice_table_chunks(table_rows, rows_per_page):
+    """
+    Yield the rows as tables of at most one page each, every one with the
+    table header; only the last one highlights the total row.
+    """
+    for start in range(0, len(table_rows), rows_per_page):
+        chunk = table_rows[start:start + rows_per_page]
+        last = start + rows_per_page >= len(table_rows)
+        yield Table([INVOICE_TABLE_HEADER] + chunk, colWidths=INVOICE_TABLE_COL_WIDTHS, repeatRows=1,
+                    style=INVOICE_TABLE_STYLE if last else INVOICE_PAGE_STYLE, hAlign="LEFT")
+
+@lru_cache(maxsize=None)
+def pdf_rows_per_page(available_height):
+    """
+    Number of table rows that fit under the repeated table header.
+    Cells are single-line, so every row has the height of a sample row.
+    """
+    header_height = Table([INVOICE_TABLE_HEADER], colWidths=INVOICE_TABLE_COL_WIDTHS,
+                          style=INVOICE_PAGE_STYLE).wrap(0, 0)[1]
+    sample_height = Table([INVOICE_TABLE_HEADER, ["x", "1", "1.00", "1.00"]], colWidths=INVOICE_TABLE_COL_WIDTHS,
+                          style=INVOICE_PAGE_STYLE).wrap(0, 0)[1]
+    return max(1, int((available_height - header_height) // (sample_height - header_height)))
+
+def write_pdf_pages(filename, header, table_rows):
+    """
+    Lay out an invoice over several pages with SimpleDocTemplate.
+    The rows are cut into page-sized tables up front, each with the table
+    header, so the layout cost stays linear in the number of lines; letting
+    platypus split one LongTable copies the remaining rows on every page.
+    """
+    width, height = A4
+    doc = SimpleDocTemplate(filename, pagesize=A4, **PDF_MARGINS)
+    # Kehyksen oletustäyte on 6 pistettä ylhäällä ja alhaalla
+    rows_per_page = pdf_rows_per_page(doc.height - 12)
+
+    story = []
+    for table in invoice_table_chunks(table_rows, rows_per_page):
+        if story:
+            story.append(PageBreak())
+        story.append(table)
+    # Lomake kannattaa vasta, kun samaa kerrosta piirretään usealle sivulle
+    reuse = len(story) > 1
+
+    def draw_page(c, doc):
+        draw_invoice_header(c, *header, reuse=reuse)
+        c.setFont("Helvetica", 9)
+        c.drawRightString(width - 50, 25, f"Page {doc.page}")
+
+    doc.build(story, onFirstPage=draw_page, onLaterPages=draw_page)
+
+@timed("render_xml")
+def generate_statement_xml(customer_id, customer_name, billable_company, orders, filename, totals=None):
+    """
+    Generate a consolidated XML statement: a <Statement> with the customer
+    details, every order as an <Invoice> section and the statement total.
+    The filename may also be a writable binary file object. The document is
+    streamed with etree.xmlfile.
+    """
+    if totals is None:
+        totals = [compute_totals(items) for _order_id, items in orders]
+
+    header = [
+        ("CustomerID", str(customer_id)),
+        ("CreationDate", datetime.today().strftime("%Y-%m-%d")),
+        ("CustomerName", customer_name),
+        ("BillableCompany", billable_company)
+    ]
+    statement_total = sum(order_totals.total for order_totals in totals)
+
+    def write(output):
+        with etree.xmlfile(output, encoding="UTF-8") as xf:
+            xf.write_declaration()
+            with xf.element("Statement"):
+                for tag, text in header + [("StatementTotal", str(statement_total))]:
+                    element = etree.Element(tag)
+                    element.text = text
+                    xf.write("\n  ")
+                    xf.write(element)
+
+                xf.write("\n  ")
+                with xf.element("Invoices"):
+                    for (order_id, items), order_totals in zip(orders, totals):
+                        invoice_header = xml_header_fields(order_id, customer_name, billable_company,
+                                                           items[0].get("DUE_DATE", "Unknown"))
+                        xf.write("\n    ")
+                        write_invoice_element(xf, invoice_header, items, order_totals, level=2)
+                    xf.write("\n  ")
+                xf.write("\n")
+        output.write(b"\n")
+
+    if hasattr(filename, "write"):
+        write(filename)
+    else:
+        with open(filename, "wb") as f:
+            write(f)
+    log.debug(f"✅ Generated XML statement: {getattr(filename, 'name', filename)}")
+
+def draw_statement_header(c, customer_id, customer_name, billable_company, creation_date, reuse=False):
+    """Draw the static layer and the customer details of one statement page."""
+    width, height = A4
+    draw_static_layer(c, reuse, title="Statement")
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(400, height - 70, f"Customer ID: {customer_id}")
+    c.drawString(400, height - 90, f"Creation Date: {creation_date}")
+
+    c.setFont("Helvetica", 10)
+    c.drawString(50, height - 145, f"{customer_name}")
+    c.drawString(50, height - 160, f"{billable_company}")
+
+@timed("render_pdf")
+def generate_statement_pdf(customer_id, customer_name, billable_company, orders, filename, totals=None):
+    """
+    Generate a consolidated PDF statement with one section per order: a
+    heading with the order ID and due date, followed by the item table.
+    The sections flow over as many pages as needed and the statement total
+    is printed at the end.
+    """
+    if totals is None:
+        totals = [compute_totals(items) for _order_id, items in orders]
+
+    width, height = A4
+    creation_date = datetime.today().strftime("%Y-%m-%d")
+    doc = SimpleDocTemplate(filename, pagesize=A4, **PDF_MARGINS)
+    rows_per_page = pdf_rows_per_page(doc.height - 12)
+
+    story = []
+    for (order_id, items), order_totals in zip(orders, totals):
+        due_date = items[0].get("DUE_DATE", "Unknown")
+        story.append(Paragraph(escape(f"Invoice {order_id} - Due Date: {due_date}"), STATEMENT_SECTION_STYLE))
+        story.extend(invoice_table_chunks(invoice_table_rows(items, order_totals), rows_per_page))
+        story.append(Spacer(1, 12))
+
+    statement_total = sum(order_totals.total for order_totals in totals)
+    story.append(Table([["", "", "Statement total", f"{statement_total:.2f}"]], colWidths=INVOICE_TABLE_COL_WIDTHS,
+                       style=STATEMENT_TOTAL_STYLE, hAlign="LEFT"))
+    # Arvio sivumäärästä: jokaisella osiolla on rivien lisäksi otsikko ja summarivi
+    reuse = sum(len(items) + 2 for _order_id, items in orders) > rows_per_page
+
+    def draw_page(c, doc):
+        draw_statement_header(c, customer_id, customer_name, billable_company, creation_date, reuse)
+        c.setFont("Helvetica", 9)
+        c.drawRightString(width - 50, 25, f"Page {doc.page}")
+
+    doc.build(story, onFirstPage=draw_page, onLaterPages=draw_page)
+    log.debug(f"✅ Generated PDF statement: {getattr(filename, 'name', filename)}")
 
 # For testing purposes, call generate_invoice_files() when this script is executed directly.
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     generate_invoice_files()
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+
+# Manifesti: tilauksen ID -> syötteiden tiiviste ja generoidut tiedostot
+MANIFEST_FILE = "invoices/manifest.json"
+
+# Laskurivin kentät, jotka vaikuttavat generoituun laskuun
+ITEM_FIELDS = ("ORDER_LINE_ID", "PRODUCT_ID", "PRODUCT_NAME", "QUANTITY", "UNIT_PRICE")
+
+def load_manifest(path=MANIFEST_FILE):
+    """
+    Load the invoice manifest of previous runs.
+    Returns an empty dict if the manifest does not exist or cannot be read.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Manifestia ei voitu lukea ({path}): {e}")
+        return {}
+
+def save_manifest(manifest, path=MANIFEST_FILE):
+    """
+    Write the invoice manifest atomically.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def invoice_hash(renderer_version, order_id, customer_name, billable_company, due_date, items):
+    """
+    Hash the header fields and line items of an invoice together with the
+    renderer version, so a template change invalidates the cached files.
+    """
+    payload = [
+        renderer_version,
+        order_id,
+        customer_name,
+        billable_company,
+        due_date,
+        [[item.get(field) for field in ITEM_FIELDS] for item in items]
+    ]
+    data = json.dumps(payload, default=str, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def is_unchanged(manifest, order_id, digest):
+    """
+    Check whether an order was already rendered from identical inputs and
+    its output files still exist.
+    """
+    entry = manifest.get(str(order_id))
+    if not entry or entry.get("hash") != digest:
+        return False
+    return all(os.path.exists(path) for path in entry.get("files", []))
+
+def record_invoice(manifest, order_id, digest, files):
+    """
+    Record the hash and output files of a rendered invoice.
+    In-memory artifacts have no local files, so only their hash is kept.
+    main() restores the previous manifest if the upload fails, so a kept
+    entry also means that the files were uploaded.
+    """
+    paths = [path for path in files if isinstance(path, str)]
+    manifest[str(order_id)] = {"hash": digest, "files": paths}
@@ -0,0 +1,92 @@
+import json
+import os
+from datetime import datetime
+
+# Inkrementaalisen ajon tila: viimeisin käsitelty tilaus
+STATE_FILE = "invoice_state.json"
+
+def load_state(path=STATE_FILE):
+    """
+    Load the persisted high-water mark of the previous run.
+    Returns an empty dict if no state has been saved yet.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Tilatiedostoa ei voitu lukea ({path}): {e}")
+        return {}
+
+def save_state(last_order_id, path=STATE_FILE):
+    """
+    Persist the last processed SalesOrderID.
+    The file is written atomically so an interrupted run keeps the old state.
+    """
+    state = {
+        "last_order_id": last_order_id,
+        "updated_at": datetime.now().isoformat(timespec="seconds")
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+def track_last_order(orders, progress):
+    """
+    Pass an order stream through and record the ID of the latest order in
+    progress["last_order_id"]. Every yielded order is processed before
+    iter_invoice_files() finishes; use resume_order_id() to leave out
+    orders that failed.
+    """
+    for order_id, items in orders:
+        progress["last_order_id"] = order_id
+        yield order_id, items
+
+def track_highest_order(orders, progress):
+    """
+    Pass an order stream that is not ordered by order ID (e.g. ordered by
+    customer) through and record the highest order ID in
+    progress["last_order_id"] only once the stream has been exhausted.
+    """
+    last_order_id = None
+    for order_id, items in orders:
+        yield order_id, items
+        if last_order_id is None or order_id > last_order_id:
+            last_order_id = order_id
+
+    if last_order_id is not None:
+        progress["last_order_id"] = last_order_id
+
+def track_last_statement_order(statements, progress):
+    """
+    Pass a per-customer statement stream through and record the highest
+    order ID in progress["last_order_id"]. The stream is ordered by customer,
+    so the ID is only a safe high-water mark once every statement has been
+    processed; it is not recorded if the stream is closed early.
+    """
+    last_order_id = None
+    for customer_id, orders in statements:
+        yield customer_id, orders
+        for order_id, _items in orders:
+            if last_order_id is None or order_id > last_order_id:
+                last_order_id = order_id
+
+    if last_order_id is not None:
+        progress["last_order_id"] = last_order_id
+
+def resume_order_id(progress, stats):
+    """
+    Return the high-water mark to persist after a run, or None.
+    If an invoice failed, the mark stops just before the lowest failed order
+    so that it is retried on the next run. A failed statement has no single
+    order ID, so then nothing is persisted.
+    """
+    last_order_id = progress.get("last_order_id")
+    first_failed = stats.get("lowest_failed_order")
+    if last_order_id is None or first_failed is None:
+        return last_order_id
+    if not isinstance(first_failed, int):
+        return None
+    return min(last_order_id, first_failed - 1)
@@ -0,0 +1,38 @@
+from collections import namedtuple
+from decimal import Decimal
+
+# Arvonlisäveron osuus laskun loppusummasta (0 = laskuihin ei lisätä veroa)
+TAX_RATE = Decimal("0")
+CENT = Decimal("0.01")
+
+# Laskun summat: rivisummat rivien järjestyksessä, välisumma, vero ja loppusumma
+InvoiceTotals = namedtuple("InvoiceTotals", ["line_totals", "subtotal", "tax", "total"])
+
+def to_decimal(value):
+    """
+    Convert a float to Decimal through its shortest repr, so 12.34 stays 12.34.
+    Other values (int, Decimal, None) are returned as they are.
+    """
+    return Decimal(repr(value)) if isinstance(value, float) else value
+
+def line_total(quantity, unit_price):
+    """Return quantity * unit_price exactly, or 0 if the values cannot be multiplied."""
+    try:
+        return to_decimal(quantity) * to_decimal(unit_price)
+    except Exception:
+        return 0
+
+def compute_totals(items, tax_rate=TAX_RATE):
+    """
+    Compute the line totals, the subtotal, tax and the invoice total of one
+    order in a single pass. The arithmetic stays in int/Decimal, so the sums
+    are exact; float prices are converted to Decimal instead of being
+    silently dropped from the total.
+    """
+    line_totals = [line_total(item.get("QUANTITY", 0), item.get("UNIT_PRICE", 0)) for item in items]
+    subtotal = sum(line_totals)
+    if not tax_rate:
+        return InvoiceTotals(line_totals, subtotal, 0, subtotal)
+
+    tax = (Decimal(subtotal) * tax_rate).quantize(CENT)
+    return InvoiceTotals(line_totals, subtotal, tax, subtotal + tax)
@@ -1,45 +1,155 @@
-from db_handler import group_orders_by_invoice
-from invoice_generator import generate_invoice_files
-from blob_handler import upload_files_to_blob
-from scan_schema import check_database_connection
+import argparse
+import logging
+import sys
+from db_handler import has_orders, iter_orders_by_invoice, iter_statements_by_customer
+from invoice_generator import generate_invoice_files, iter_invoice_files
+from blob_handler import BACKENDS, get_backend, upload_files_to_blob
+from scan_schema import check_database_connection, ensure_invoice_query
+from invoice_manifest import load_manifest, save_manifest
+from invoice_state import (load_state, resume_order_id, save_state, track_highest_order, track_last_order,
+                           track_last_statement_order)
+from pipeline import run_pipeline
+from invoice_batch import XML_BATCH_SIZE, XmlBatchWriter
+from metrics import report
 
-def main():
+def main(workers=1, full=False, backend="local", pipelined=False, in_memory=False, normalized=False,
+         fetch_workers=1, xml_batch_size=None, xml_batch_per_customer=False, compress=False, statements=False,
+         limit=None, min_order_id=None, max_order_id=None, dry_run=False):
     """
     Main function to fetch data, generate invoices, and upload to Azure Blob Storage.
+    With workers > 1 the invoices are rendered in parallel worker processes.
+    Only orders newer than the previous run are processed and unchanged
+    invoices are skipped, unless full is set.
+    The files are uploaded to the named storage backend ("local" or "azure").
+    With pipelined, fetching, rendering and uploading run as overlapping stages.
+    With in_memory the invoices are not written to the invoices directory.
+    With normalized the order headers and lines are fetched as separate result sets.
+    With fetch_workers > 1 the orders are fetched as keyset pages over several connections.
+    With xml_batch_size (or xml_batch_per_customer) the XML invoices are written
+    into <Invoices> batch documents, gzip-compressed with compress.
+    With statements one consolidated statement is generated per customer
+    instead of one invoice per order.
+    With limit at most that many invoices are generated. min_order_id and
+    max_order_id select an explicit (min, max] order ID range; an explicit
+    min_order_id replaces the incremental state and the state is not updated.
+    With dry_run the orders are fetched and the invoices that would be
+    generated are listed, but nothing is rendered, uploaded or recorded.
+    Returns True if the run succeeded (also when there was nothing to do).
     """
     # Tarkista tietokantayhteys ensin
     connection_ok, error_message = check_database_connection()
     if not connection_ok:
         print(error_message)
-        return
+        return False
 
+    # Generoi kysely uudelleen vain, jos tietokantarakenne on muuttunut
+    if not ensure_invoice_query():
+        print("⚠️ invoice_query.sql puuttuu eikä sitä voitu generoida. Lopetetaan.")
+        return False
+
+    manifest_before = None
     try:
-        # Fetch and group order details
+        # Luo tallennuskohde heti, jotta asetusvirheet huomataan ennen generointia
+        storage = get_backend(backend)
+
+        # Inkrementaalinen ajo: jatka edellisen ajon viimeisestä tilauksesta
+        record_progress = min_order_id is None and not dry_run
+        if min_order_id is None and not full:
+            min_order_id = load_state().get("last_order_id")
+        if min_order_id is not None:
+            print(f"🔖 Haetaan tilaukset, joiden ID on suurempi kuin {min_order_id} (--full hakee kaikki)")
+        if max_order_id is not None:
+            print(f"🔖 Haetaan tilaukset ID:hen {max_order_id} asti")
+
+        # Tarkista kevyellä kyselyllä että tilauksia on olemassa
         print("📊 Haetaan tilauksia...")
-        orders = group_orders_by_invoice()
-        
-        if not orders:
+        orders_found = has_orders(min_order_id, max_order_id)
+        if orders_found is None:
+            print("⚠️ Tilausten haku epäonnistui. Lopetetaan.")
+            return False
+        if not orders_found:
             print("⚠️ Tilauksia ei löytynyt. Lopetetaan.")
-            return
+            return True
+
+        xml_batch = None
+        if (xml_batch_size or xml_batch_per_customer) and not dry_run:
+            xml_batch = XmlBatchWriter(batch_size=xml_batch_size or XML_BATCH_SIZE,
+                                       per_customer=xml_batch_per_customer, compress=compress)
+
+        progress = {}
+        stats = {}
+        if statements:
+            # Asiakaskohtainen kooste: kaikki asiakkaan tilaukset yhteen laskuun
+            orders = iter_statements_by_customer(min_order_id=min_order_id, max_order_id=max_order_id)
+            track_progress = track_last_statement_order
+        elif xml_batch_per_customer:
+            # Asiakaskohtaiset koosteet tarvitsevat asiakkaan mukaan järjestetyn virran
+            orders = iter_orders_by_invoice(min_order_id=min_order_id, max_order_id=max_order_id,
+                                            by_customer=True)
+            track_progress = track_highest_order
+        else:
+            orders = iter_orders_by_invoice(min_order_id=min_order_id, normalized=normalized,
+                                            fetch_workers=fetch_workers, max_order_id=max_order_id)
+            track_progress = track_last_order
+
+        if dry_run:
+            # Kuivaharjoitus: listaa generoitavat laskut renderöimättä ja lataamatta
+            for _ in iter_invoice_files(orders, use_cache=not full, target_count=limit, stats=stats,
+                                        statements=statements, dry_run=True):
+                pass
+            print(f"🧪 Kuivaharjoitus: {stats['orders']} tilausta, {stats['generated']} laskua generoitaisiin, "
+                  f"{stats['unchanged']} ennallaan")
+            return True
+
+        # Laskut merkitään manifestiin jo renderöitäessä; epäonnistunut lataus perutaan,
+        # jotta lataamattomia laskuja ei ohiteta seuraavalla ajolla
+        manifest_before = load_manifest()
 
-        # Generate XML and PDF invoices
-        print("📄 Generoidaan laskuja...")
-        invoice_files = generate_invoice_files()
-        
-        if not invoice_files:
+        if pipelined:
+            # Generoi ja lataa laskut rinnakkain sitä mukaa kun tilauksia saapuu
+            print("📄☁️ Generoidaan ja ladataan laskuja liukuhihnana...")
+            upload_success = run_pipeline(orders, storage, workers=workers, use_cache=not full,
+                                          target_count=limit, progress=progress,
+                                          in_memory=in_memory, xml_batch=xml_batch, statements=statements,
+                                          stats=stats, track_progress=track_progress)
+        else:
+            orders = track_progress(orders, progress)
+
+            # Generate XML and PDF invoices from the streamed order groups
+            print("📄 Generoidaan laskuja...")
+            invoice_files = generate_invoice_files(orders, workers=workers, use_cache=not full,
+                                                   in_memory=in_memory, xml_batch=xml_batch,
+                                                   statements=statements, target_count=limit, stats=stats)
+
+            if invoice_files is None:
+                print("⚠️ Laskuja ei voitu generoida. Lopetetaan.")
+                return False
+
+            # Upload invoices to Azure Blob Storage
+            print("☁️ Ladataan tiedostoja Azure Blob Storageen...")
+            upload_success = upload_files_to_blob(invoice_files, storage)
+
+        if not stats.get("orders"):
+            # has_orders() löysi tilauksia, joten tyhjä virta tarkoittaa hakuvirhettä
             print("⚠️ Laskuja ei voitu generoida. Lopetetaan.")
-            return
+            return False
 
-        # Upload invoices to Azure Blob Storage
-        print("☁️ Ladataan tiedostoja Azure Blob Storageen...")
-        upload_success = upload_files_to_blob(invoice_files)
-        
         if upload_success:
             print("✅ Tiedostot ladattu onnistuneesti Azure Blob Storageen.")
+            last_order_id = resume_order_id(progress, stats) if record_progress else None
+            if stats.get("failed"):
+                print(f"⚠️ {stats['failed']} laskun generointi epäonnistui; ne yritetään uudelleen seuraavalla ajolla")
+            if last_order_id is not None:
+                save_state(last_order_id)
+            return not stats.get("failed")
         else:
             print("⚠️ Tiedostojen lataus Azure Blob Storageen epäonnistui.")
+            save_manifest(manifest_before)
+            return False
 
     except Exception as e:
+        if manifest_before is not None:
+            save_manifest(manifest_before)
         print(f"""
 ⚠️ Virhe ohjelman suorituksessa: {str(e)}
 
@@ -53,6 +163,75 @@ Voit ajaa yksittäiset vaiheet erikseen:
 2. python db_handler.py (tilausten haku)
 3. python invoice_generator.py (laskujen generointi)
 """)
+        return False
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Generoi laskut Azure SQL -tietokannasta.")
+    parser.add_argument("--limit", type=int, metavar="N",
+                        help="Generoi enintään N laskua (oletus: kaikki)")
+    parser.add_argument("--min-order-id", type=int, metavar="ID",
+                        help="Käsittele tilaukset, joiden ID on suurempi kuin ID (ohittaa edellisen ajon tilan)")
+    parser.add_argument("--max-order-id", type=int, metavar="ID",
+                        help="Käsittele tilaukset ID:hen asti (mukaan lukien)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Hae tilaukset ja listaa generoitavat laskut, mutta älä renderöi, lataa tai tallenna tilaa")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                        help="Lokitaso; DEBUG tulostaa myös kyselyt ja tilauskohtaiset viestit (oletus: INFO)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Laskujen renderöintiin käytettävien prosessien määrä (oletus: 1)")
+    parser.add_argument("--full", action="store_true",
+                        help="Generoi kaikki laskut uudelleen edellisen ajon tilasta ja manifestista välittämättä")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="local",
+                        help="Tallennuskohde: paikallinen kansio tai Azure Blob Storage (oletus: local)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Hae, generoi ja lataa laskut limittäin rajatuin jonoin")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Renderöi laskut muistiin ja lähetä ne suoraan tallennuskohteeseen ilman invoices/-kansiota")
+    parser.add_argument("--normalized", action="store_true",
+                        help="Hae tilausten otsikkotiedot ja laskurivit erillisinä tulosjoukkoina")
+    parser.add_argument("--fetch-workers", type=int, default=1,
+                        help="Hae tilaukset sivuina näin monella rinnakkaisella yhteydellä (oletus: 1, yksi kysely)")
+    parser.add_argument("--xml-batch", type=int, metavar="N",
+                        help="Kirjoita XML-laskut N laskun <Invoices>-koostedokumentteihin erillisten tiedostojen sijaan")
+    parser.add_argument("--xml-batch-per-customer", action="store_true",
+                        help="Aloita uusi XML-koostedokumentti aina asiakkaan vaihtuessa")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Pakkaa XML-koostedokumentit gzip-muotoon")
+    parser.add_argument("--metrics-json", metavar="PATH",
+                        help="Tallenna ajon mittarit (vaiheiden kestot, rivit/s, tavut) JSON-tiedostoon")
+    parser.add_argument("--metrics-prom", metavar="PATH",
+                        help="Tallenna ajon mittarit Prometheuksen textfile-muodossa (esim. node_exporterille)")
+    parser.add_argument("--statements", action="store_true",
+                        help="Generoi yksi koostelasku asiakasta kohden tilauskohtaisten laskujen sijaan")
+    args = parser.parse_args()
+    if args.limit is not None and args.limit <= 0:
+        parser.error("--limit täytyy olla positiivinen")
+    if (args.min_order_id is not None and args.max_order_id is not None
+            and args.min_order_id >= args.max_order_id):
+        parser.error("--min-order-id täytyy olla pienempi kuin --max-order-id")
+    if args.statements and (args.xml_batch or args.xml_batch_per_customer or args.normalized
+                            or args.fetch_workers > 1):
+        parser.error("--statements ei toimi yhdessä valitsimien --xml-batch, --xml-batch-per-customer, "
+                     "--normalized tai --fetch-workers kanssa")
+    if args.xml_batch_per_customer and (args.normalized or args.fetch_workers > 1):
+        parser.error("--xml-batch-per-customer hakee tilaukset asiakkaan mukaan järjestettyinä yhdellä "
+                     "kyselyllä, eikä toimi valitsimien --normalized tai --fetch-workers kanssa")
+    return args
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    success = False
+    try:
+        success = main(workers=args.workers, full=args.full, backend=args.backend, pipelined=args.pipeline,
+             in_memory=args.in_memory, normalized=args.normalized,
+             fetch_workers=args.fetch_workers, xml_batch_size=args.xml_batch,
+             xml_batch_per_customer=args.xml_batch_per_customer, compress=args.gzip,
+             statements=args.statements, limit=args.limit, min_order_id=args.min_order_id,
+             max_order_id=args.max_order_id, dry_run=args.dry_run)
+    finally:
+        # Yhteenveto vaiheiden kestoista myös keskeytyneestä ajosta
+        report(args.metrics_json, args.metrics_prom)
+    # Ajastettu ajo tunnistaa epäonnistumisen paluukoodista
+    sys.exit(0 if success else 1)
@@ -0,0 +1,209 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Kuinka monta mittausta kustakin vaiheesta säilytetään persentiilejä varten
+TIMER_SAMPLE_SIZE = 10000
+# Vaiheet, joiden seinäkelloaikana rivien hakunopeus lasketaan
+FETCH_STAGES = ("query", "fetch_rows")
+PROMETHEUS_PREFIX = "invoice"
+
+class Metrics:
+    """
+    Thread-safe stage timers and counters.
+    Every timer keeps its exact count and total, and a uniform sample of at
+    most sample_size durations for the percentiles, so memory use stays
+    bounded however many invoices a run renders. timer() also records the
+    wall-clock span from the first start to the last end of each stage.
+    """
+
+    def __init__(self, sample_size=TIMER_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self.reset()
+
+    def reset(self):
+        """Forget all recorded timings and counters."""
+        self.timers = {}  # name -> [count, total seconds, samples]
+        self.counters = {}
+        self.spans = {}  # name -> [first start, last end]
+
+    def observe(self, name, seconds):
+        """Record one duration of the named stage."""
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0, []])
+            timer[0] += 1
+            timer[1] += seconds
+            samples = timer[2]
+            if len(samples) < self.sample_size:
+                samples.append(seconds)
+            else:
+                # Reservoir sampling: jokainen mittaus on otoksessa yhtä todennäköisesti
+                slot = self._random.randrange(timer[0])
+                if slot < self.sample_size:
+                    samples[slot] = seconds
+
+    def count(self, name, amount=1):
+        """Add amount to the named counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, name):
+        """Context manager that records the duration of its block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.observe(name, end - start)
+            with self._lock:
+                span = self.spans.setdefault(name, [start, end])
+                span[0] = min(span[0], start)
+                span[1] = max(span[1], end)
+
+    def snapshot(self):
+        """Return the recorded samples and counters as plain data, e.g. to send them between processes."""
+        with self._lock:
+            return ({name: list(timer[2]) for name, timer in self.timers.items()}, dict(self.counters))
+
+    def merge(self, snapshot):
+        """Add the samples and counters of a snapshot() to this registry."""
+        timers, counters = snapshot
+        for name, samples in timers.items():
+            for seconds in samples:
+                self.observe(name, seconds)
+        for name, amount in counters.items():
+            self.count(name, amount)
+
+    def summary(self):
+        """
+        Return the timers as {name: {count, total, p50, p95}} and the counters,
+        with rows_per_second derived from the row count and the wall-clock
+        time of the fetch, so parallel fetch threads are not counted twice.
+        """
+        with self._lock:
+            timers = {
+                name: dict(count=count, total=total, p50=percentile(samples, 50), p95=percentile(samples, 95))
+                for name, (count, total, samples) in sorted(self.timers.items())
+            }
+            counters = dict(sorted(self.counters.items()))
+            spans = [self.spans[name] for name in FETCH_STAGES if name in self.spans]
+
+        fetch_time = max(end for _, end in spans) - min(start for start, _ in spans) if spans else 0
+        if fetch_time > 0:
+            counters["rows_per_second"] = round(counters.get("rows_fetched", 0) / fetch_time, 1)
+        return {"timers": timers, "counters": counters}
+
+def percentile(samples, p):
+    """Return the nearest-rank p-th percentile of the samples, or None if there are none."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+# Ajon yhteiset mittarit
+METRICS = Metrics()
+
+def _reset_after_fork():
+    # Työprosessi aloittaa tyhjästä, eikä se peri mahdollisesti lukittua lukkoa
+    METRICS._lock = threading.Lock()
+    METRICS.reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def timer(name):
+    """Time a block into the shared registry: with timer("upload"): ..."""
+    return METRICS.timer(name)
+
+def count(name, amount=1):
+    """Add amount to a counter of the shared registry."""
+    METRICS.count(name, amount)
+
+def timed(name):
+    """Decorator that times every call of a function into the shared registry."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def call_measured(func, *args, **kwargs):
+    """
+    Run func in a worker process and return (result, snapshot) with the
+    metrics it recorded; unpack_measured() merges them in the parent.
+    """
+    METRICS.reset()
+    result = func(*args, **kwargs)
+    snapshot = METRICS.snapshot()
+    METRICS.reset()
+    return result, snapshot
+
+def unpack_measured(measured):
+    """Merge the snapshot of a call_measured() result and return the result."""
+    result, snapshot = measured
+    METRICS.merge(snapshot)
+    return result
+
+def format_summary(summary):
+    """Format a summary() as printable lines."""
+    lines = ["📈 Vaiheiden kestot (s):"]
+    for name, timer in summary["timers"].items():
+        lines.append(f"   {name:<16} n={timer['count']:<8} total={timer['total']:.3f} "
+                     f"p50={timer['p50']:.4f} p95={timer['p95']:.4f}")
+    for name, value in summary["counters"].items():
+        lines.append(f"   {name:<16} {value}")
+    return "\n".join(lines)
+
+def prometheus_text(summary, prefix=PROMETHEUS_PREFIX):
+    """Render a summary() in the Prometheus text exposition format."""
+    lines = [
+        f"# HELP {prefix}_stage_seconds Duration of one call of a pipeline stage.",
+        f"# TYPE {prefix}_stage_seconds summary"
+    ]
+    for name, timer in summary["timers"].items():
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+            lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{quantile}"}} {timer[key]}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {timer["total"]}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {timer["count"]}')
+
+    for name, value in summary["counters"].items():
+        metric = f"{prefix}_{name}" if name == "rows_per_second" else f"{prefix}_{name}_total"
+        lines.append(f"# TYPE {metric} {'gauge' if name == 'rows_per_second' else 'counter'}")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+def _write_atomic(path, text):
+    # node_exporterin textfile-kerääjä ei saa nähdä puoliksi kirjoitettua tiedostoa
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def report(json_path=None, prometheus_path=None):
+    """
+    Print the summary of the shared registry and optionally write it as JSON
+    and as a Prometheus textfile. Returns the summary.
+    """
+    summary = METRICS.summary()
+    if not summary["timers"] and not summary["counters"]:
+        return summary
+
+    print(format_summary(summary))
+    if json_path:
+        _write_atomic(json_path, json.dumps(summary, indent=2) + "\n")
+        print(f"📈 Mittarit tallennettu: {json_path}")
+    if prometheus_path:
+        _write_atomic(prometheus_path, prometheus_text(summary))
+        print(f"📈 Mittarit tallennettu: {prometheus_path}")
+    return summary
@@ -0,0 +1,92 @@
+import logging
+import queue
+import threading
+from blob_handler import upload_files_to_blob
+from invoice_generator import iter_invoice_files
+from invoice_state import track_last_order, track_last_statement_order
+
+log = logging.getLogger(__name__)
+
+# Kuinka monta tilausryhmää tietokannasta luetaan valmiiksi jonoon
+ORDER_QUEUE_SIZE = 16
+
+_DONE = object()
+
+class _Failure:
+    """Wraps an exception raised by the producer thread."""
+    def __init__(self, error):
+        self.error = error
+
+def prefetch(iterable, maxsize=ORDER_QUEUE_SIZE):
+    """
+    Read an iterable in a background thread into a bounded queue.
+    The producer blocks when the queue is full, so at most maxsize items are
+    buffered. Closing the returned generator stops and closes the source.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # Odota tilaa jonossa, mutta lopeta jos kuluttaja on sulkenut virran
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except BaseException as e:
+            put(_Failure(e))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            put(_DONE)
+
+    thread = threading.Thread(target=produce, name="order-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def run_pipeline(orders, backend, workers=1, use_cache=True, target_count=None, progress=None,
+                 in_memory=False, xml_batch=None, statements=False, stats=None, track_progress=None):
+    """
+    Run fetch, render and upload as overlapping stages.
+    Order groups are read ahead into a bounded queue, rendered as soon as they
+    arrive and each finished invoice is handed straight to the upload pool.
+    If progress is given, the ID of the last rendered order is stored in it
+    with track_progress (track_last_order by default); orders that were only
+    read ahead are not counted.
+    With in_memory the rendered bytes go straight to the backend.
+    With xml_batch the XML goes into batch documents, uploaded as each one is finished.
+    With statements the orders are per-customer groups rendered as one statement each.
+    Counters are stored in stats if a dict is given (see iter_invoice_files()).
+    Returns True if every generated file was uploaded.
+    """
+    if stats is None:
+        stats = {}
+    orders = prefetch(orders)
+    if progress is not None:
+        if track_progress is None:
+            track_progress = track_last_statement_order if statements else track_last_order
+        orders = track_progress(orders, progress)
+    invoices = iter_invoice_files(orders, workers, use_cache, target_count, stats, in_memory, xml_batch,
+                                  statements)
+    upload_success = upload_files_to_blob(invoices, backend)
+
+    log.info(f"Processed {stats.get('orders', 0)} order(s), generated {stats.get('generated', 0)} invoice(s).")
+    return upload_success
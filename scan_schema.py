@@ -1,9 +1,13 @@
 import os
+import re
 import json
 import pymssql
+from collections import deque
 from typing import Dict, List, Tuple
 from dotenv import load_dotenv
 from config import load_config
+from db_pool import get_connection
+from metrics import timed
 
 # Lataa asetukset
 config = load_config()
@@ -16,17 +20,62 @@ database = config["DB_NAME"]
 username = config["DB_USER"]
 password = config["DB_PASSWORD"]
 
+# Laskun kentät ja niitä vastaavat sarakkeet
+REQUIRED_FIELDS = {
+    "ORDER_ID": "SalesOrderID",
+    "CUSTOMER_ID": "CustomerID",
+    "CUSTOMER_NAME": "CompanyName",
+    "CUSTOMER_EMAIL": "EmailAddress",
+    "DUE_DATE": "DueDate",
+    "ORDER_LINE_ID": "SalesOrderDetailID",
+    "PRODUCT_ID": "ProductID",
+    "PRODUCT_NAME": "Name",
+    "QUANTITY": "OrderQty",
+    "UNIT_PRICE": "UnitPrice",
+    "CUSTOMER_ADDRESS": "AddressID"
+}
+
+# Taulu, josta kukin kenttä haetaan
+FIELD_TABLE_MAPPING = {
+    "ORDER_ID": "SalesOrderHeader",
+    "CUSTOMER_ID": "Customer",
+    "CUSTOMER_NAME": "Customer",
+    "CUSTOMER_EMAIL": "Customer",
+    "DUE_DATE": "SalesOrderHeader",
+    "ORDER_LINE_ID": "SalesOrderDetail",
+    "PRODUCT_ID": "Product",
+    "PRODUCT_NAME": "Product",
+    "QUANTITY": "SalesOrderDetail",
+    "UNIT_PRICE": "SalesOrderDetail",
+    "CUSTOMER_ADDRESS": "CustomerAddress"
+}
+
+# Tarvittavat liitokset: (taulu, liitettävä taulu, liitossarake)
+REQUIRED_JOINS = [
+    ("SalesOrderHeader", "Customer", "CustomerID"),
+    ("Customer", "CustomerAddress", "CustomerID"),
+    ("SalesOrderHeader", "SalesOrderDetail", "SalesOrderID"),
+    ("SalesOrderDetail", "Product", "ProductID")
+]
+
+# Skeemaskannauksen välimuisti
+SCHEMA_CACHE_FILE = "schema_cache.json"
+# Kasvata, kun kyselyn generointi muuttuu, jotta invoice_query.sql luodaan uudelleen
+QUERY_GENERATOR_VERSION = "5"
+
+# Rivin valintajärjestys tauluille, joista otetaan vain yksi rivi per laskurivi
+# (esim. asiakkaan useasta osoitteesta pääosoite)
+PREFERRED_ROW_ORDER = {
+    "CustomerAddress": ["CASE WHEN AddressType = N'Main Office' THEN 0 ELSE 1 END", "AddressID"]
+}
+
+@timed("schema_check")
 def check_database_connection():
     """Tarkista tietokantayhteyden tila ja palauta virheilmoitus."""
     try:
-        conn = pymssql.connect(
-            server=server,
-            user=f"{username}@{server.split('.')[0]}",
-            password=password,
-            database=database,
-            timeout=10  # Lisätään timeout-arvo
-        )
-        conn.close()
+        # Yhteys jää pooliin seuraavien vaiheiden käyttöön
+        with get_connection():
+            pass
         return True, None
     except pymssql.OperationalError as e:
         if "is not currently available" in str(e):
@@ -49,56 +98,120 @@ Azure Portal: https://portal.azure.com
     except Exception as e:
         return False, f"⚠️ Odottamaton virhe: {str(e)}"
 
-def scan_database_structure():
-    """Skannaa tietokannan rakenne."""
+def get_schema_fingerprint(cursor) -> str:
+    """
+    Laske kevyt sormenjälki tietokannan rakenteesta: viimeisin muutosaika ja
+    objektien määrä sys.objects-näkymästä (määrä huomaa myös poistetut objektit).
+    """
+    cursor.execute("""
+        SELECT
+            CONVERT(varchar(33), MAX(modify_date), 126) AS last_modified,
+            COUNT(*) AS object_count
+        FROM sys.objects
+    """)
+    row = cursor.fetchone()
+    return f"{row['last_modified']}|{row['object_count']}"
+
+def _cache_key() -> str:
+    return f"{server}/{database}"
+
+def load_schema_cache(fingerprint: str):
+    """Palauta välimuistissa oleva skannaus, jos sormenjälki ja generaattorin versio täsmäävät."""
+    if not os.path.exists(SCHEMA_CACHE_FILE):
+        return None
+    try:
+        with open(SCHEMA_CACHE_FILE, "r") as f:
+            entry = json.load(f).get(_cache_key())
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Skeemavälimuistia ei voitu lukea: {e}")
+        return None
+
+    if (not entry or entry.get("fingerprint") != fingerprint
+            or entry.get("generator_version") != QUERY_GENERATOR_VERSION):
+        return None
+    return entry
+
+def save_schema_cache(fingerprint: str, columns: List[Dict], relationships: List[Dict]):
+    """Tallenna skannaustulos välimuistiin palvelimen ja tietokannan mukaan."""
+    cache = {}
+    if os.path.exists(SCHEMA_CACHE_FILE):
+        try:
+            with open(SCHEMA_CACHE_FILE, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+    cache[_cache_key()] = {
+        "fingerprint": fingerprint,
+        "generator_version": QUERY_GENERATOR_VERSION,
+        "columns": columns,
+        "relationships": relationships
+    }
+    tmp_path = f"{SCHEMA_CACHE_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, SCHEMA_CACHE_FILE)
+
+def current_schema_fingerprint():
+    """Hae tietokannan nykyinen sormenjälki jaetun yhteyden kautta."""
+    with get_connection() as conn:
+        return get_schema_fingerprint(conn.cursor(as_dict=True))
+
+def scan_database_structure(use_cache=True):
+    """
+    Skannaa tietokannan rakenne. Käyttää välimuistia, jos rakenne ei ole muuttunut.
+    Palauttaa (sarakkeet, vierasavaimet, sormenjälki); välimuisti tallennetaan
+    vasta, kun kysely on generoitu (ks. generate_invoice_query_file()).
+    """
     # Tarkista yhteys ensin
     connection_ok, error_message = check_database_connection()
     if not connection_ok:
         print(error_message)
-        return None, None
+        return None, None, None
 
     try:
-        conn = pymssql.connect(
-            server=server,
-            user=f"{username}@{server.split('.')[0]}",
-            password=password,
-            database=database,
-            timeout=30  # Pidempi timeout skannauksen ajaksi
-        )
-        cursor = conn.cursor(as_dict=True)
-
-        # Hae taulut ja sarakkeet
-        cursor.execute("""
-            SELECT 
-                c.TABLE_SCHEMA,
-                c.TABLE_NAME,
-                c.COLUMN_NAME,
-                c.DATA_TYPE
-            FROM INFORMATION_SCHEMA.COLUMNS c
-            JOIN sys.tables t ON OBJECT_ID(c.TABLE_SCHEMA + '.' + c.TABLE_NAME) = t.object_id
-            ORDER BY c.TABLE_SCHEMA, c.TABLE_NAME, c.COLUMN_NAME;
-        """)
-        columns = cursor.fetchall()
-
-        # Hae vierasavainsuhteet
-        cursor.execute("""
-            SELECT 
-                SCHEMA_NAME(tp.schema_id) AS parent_schema,
-                tp.name AS parent_table,
-                cp.name AS parent_column,
-                SCHEMA_NAME(tr.schema_id) AS referenced_schema,
-                tr.name AS referenced_table,
-                cr.name AS referenced_column
-            FROM sys.foreign_keys fk
-            JOIN sys.foreign_key_columns fkc ON fk.object_id = fkc.constraint_object_id
-            JOIN sys.tables tp ON fkc.parent_object_id = tp.object_id
-            JOIN sys.columns cp ON fkc.parent_object_id = cp.object_id AND fkc.parent_column_id = cp.column_id
-            JOIN sys.tables tr ON fkc.referenced_object_id = tr.object_id
-            JOIN sys.columns cr ON fkc.referenced_object_id = cr.object_id AND fkc.referenced_column_id = cr.column_id
-        """)
-        relationships = cursor.fetchall()
-
-        return columns, relationships
+        with get_connection() as conn:
+            cursor = conn.cursor(as_dict=True)
+
+            fingerprint = get_schema_fingerprint(cursor)
+            cached = load_schema_cache(fingerprint) if use_cache else None
+            if cached:
+                print("✅ Tietokantarakenne ei ole muuttunut, käytetään välimuistia")
+                return cached["columns"], cached["relationships"], fingerprint
+
+            # Hae taulut ja sarakkeet
+            cursor.execute("""
+                SELECT 
+                    c.TABLE_SCHEMA,
+                    c.TABLE_NAME,
+                    c.COLUMN_NAME,
+                    c.DATA_TYPE
+                FROM INFORMATION_SCHEMA.COLUMNS c
+                JOIN sys.tables t ON OBJECT_ID(c.TABLE_SCHEMA + '.' + c.TABLE_NAME) = t.object_id
+                ORDER BY c.TABLE_SCHEMA, c.TABLE_NAME, c.COLUMN_NAME;
+            """)
+            columns = cursor.fetchall()
+
+            # Hae vierasavainsuhteet
+            cursor.execute("""
+                SELECT 
+                    fk.name AS constraint_name,
+                    SCHEMA_NAME(tp.schema_id) AS parent_schema,
+                    tp.name AS parent_table,
+                    cp.name AS parent_column,
+                    SCHEMA_NAME(tr.schema_id) AS referenced_schema,
+                    tr.name AS referenced_table,
+                    cr.name AS referenced_column
+                FROM sys.foreign_keys fk
+                JOIN sys.foreign_key_columns fkc ON fk.object_id = fkc.constraint_object_id
+                JOIN sys.tables tp ON fkc.parent_object_id = tp.object_id
+                JOIN sys.columns cp ON fkc.parent_object_id = cp.object_id AND fkc.parent_column_id = cp.column_id
+                JOIN sys.tables tr ON fkc.referenced_object_id = tr.object_id
+                JOIN sys.columns cr ON fkc.referenced_object_id = cr.object_id AND fkc.referenced_column_id = cr.column_id
+            """)
+            relationships = cursor.fetchall()
+
+            return columns, relationships, fingerprint
 
     except pymssql.Error as e:
         print(f"""
@@ -111,147 +224,300 @@ def scan_database_structure():
 2. Varmista että palomuurisäännöt sallivat yhteyden
 3. Tarkista Azure SQL -tietokannan tila portaalista
 """)
-        return None, None
+        return None, None, None
     except Exception as e:
         print(f"⚠️ Odottamaton virhe: {e}")
-        return None, None
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        return None, None, None
+
+def build_column_index(columns: List[Dict]) -> Dict[Tuple[str, str], List[Dict]]:
+    """Indeksoi sarakkeet avaimella (taulu, sarake pienillä kirjaimilla)."""
+    index = {}
+    for col in columns:
+        index.setdefault((col['TABLE_NAME'], col['COLUMN_NAME'].lower()), []).append(col)
+    return index
+
+def build_relationship_index(relationships: List[Dict]) -> Dict[Tuple[str, str], List[Dict]]:
+    """Indeksoi vierasavaimet avaimella (viittaava taulu, viitattu taulu)."""
+    index = {}
+    for rel in relationships:
+        index.setdefault((rel['parent_table'], rel['referenced_table']), []).append(rel)
+    return index
+
+def find_join(relationship_index: Dict, parent_table: str, child_table: str, join_column: str):
+    """
+    Etsi vierasavain kahden taulun välillä kumpaan tahansa suuntaan.
+    Palauttaa suhteen parent_table-taulun näkökulmasta tai None.
+    """
+    for rel in relationship_index.get((parent_table, child_table), []):
+        if join_column in (rel['parent_column'], rel['referenced_column']):
+            return {
+                'schema': rel['parent_schema'],
+                'referenced_table': f"{rel['referenced_schema']}.{rel['referenced_table']}",
+                'parent_column': rel['parent_column'],
+                'referenced_column': rel['referenced_column']
+            }
+    # Vierasavain voi osoittaa lapsitaulusta päätauluun (esim. SalesOrderDetail -> SalesOrderHeader)
+    for rel in relationship_index.get((child_table, parent_table), []):
+        if join_column in (rel['parent_column'], rel['referenced_column']):
+            return {
+                'schema': rel['referenced_schema'],
+                'referenced_table': f"{rel['parent_schema']}.{rel['parent_table']}",
+                'parent_column': rel['referenced_column'],
+                'referenced_column': rel['parent_column']
+            }
+    return None
 
-def find_required_tables(columns: List[Dict], relationships: List[Dict], required_fields: Dict[str, str]) -> Dict:
-    """Etsi tarvittavat taulut ja niiden väliset suhteet."""
+def find_required_tables(columns: List[Dict], relationships: List[Dict], required_fields: Dict[str, str],
+                         field_table_mapping: Dict[str, str] = None,
+                         required_joins: List[Tuple[str, str, str]] = None) -> Dict:
+    """
+    Etsi tarvittavat taulut ja niiden väliset suhteet.
+    Sarakkeet ja vierasavaimet indeksoidaan kerran, joten haku on lineaarinen
+    katalogin koon suhteen. Kenttien taulut ja liitokset tulevat tauluista
+    FIELD_TABLE_MAPPING ja REQUIRED_JOINS, ellei niitä anneta parametreina.
+    """
+    field_table_mapping = field_table_mapping or FIELD_TABLE_MAPPING
+    required_joins = required_joins or REQUIRED_JOINS
     field_locations = {}
     table_relationships = {}
-    
-    # Määritä päätaulu ja sen skeema
-    main_table = "SalesLT.SalesOrderHeader"  # Tämä on päätaulu
-    
-    # Etsi sarakkeiden sijainnit ja varmista oikeat taulut
-    field_table_mapping = {
-        "ORDER_ID": "SalesOrderHeader",
-        "CUSTOMER_ID": "Customer",
-        "CUSTOMER_NAME": "Customer",
-        "CUSTOMER_EMAIL": "Customer",
-        "DUE_DATE": "SalesOrderHeader",
-        "ORDER_LINE_ID": "SalesOrderDetail",
-        "PRODUCT_ID": "Product",
-        "PRODUCT_NAME": "Product",
-        "QUANTITY": "SalesOrderDetail",
-        "UNIT_PRICE": "SalesOrderDetail",
-        "CUSTOMER_ADDRESS": "CustomerAddress"
-    }
+
+    column_index = build_column_index(columns)
+    relationship_index = build_relationship_index(relationships)
 
     # Etsi sarakkeiden sijainnit
     for field, expected_name in required_fields.items():
-        target_table = field_table_mapping[field]
-        for col in columns:
-            if (col['COLUMN_NAME'].lower() == expected_name.lower() and 
-                col['TABLE_NAME'] == target_table):
-                field_locations[field] = {
-                    'schema': col['TABLE_SCHEMA'],
-                    'table': col['TABLE_NAME'],
-                    'column': col['COLUMN_NAME']
-                }
-                break
-
-    # Määritä tarvittavat JOIN-suhteet
-    required_joins = [
-        ("SalesOrderHeader", "Customer", "CustomerID"),
-        ("Customer", "CustomerAddress", "CustomerID"),
-        ("SalesOrderHeader", "SalesOrderDetail", "SalesOrderID"),
-        ("SalesOrderDetail", "Product", "ProductID")
-    ]
+        matches = column_index.get((field_table_mapping[field], expected_name.lower()))
+        if matches:
+            col = matches[0]
+            field_locations[field] = {
+                'schema': col['TABLE_SCHEMA'],
+                'table': col['TABLE_NAME'],
+                'column': col['COLUMN_NAME']
+            }
 
     # Rakenna JOIN-lausekkeet
     for parent_table, child_table, join_column in required_joins:
-        key = f"SalesLT.{parent_table}"
-        if key not in table_relationships:
-            table_relationships[key] = []
-        
-        # Etsi vastaava suhde relationships-listasta
-        for rel in relationships:
-            if (rel['parent_table'] == parent_table and 
-                rel['referenced_table'] == child_table and 
-                (rel['parent_column'] == join_column or 
-                 rel['referenced_column'] == join_column)):
-                table_relationships[key].append({
-                    'referenced_table': f"{rel['referenced_schema']}.{rel['referenced_table']}",
-                    'parent_column': rel['parent_column'],
-                    'referenced_column': rel['referenced_column']
-                })
-                break
+        join = find_join(relationship_index, parent_table, child_table, join_column)
+        if join is None:
+            continue
+        key = f"{join.pop('schema')}.{parent_table}"
+        table_relationships.setdefault(key, []).append(join)
 
     return field_locations, table_relationships
 
-def generate_sql_query(field_locations: Dict, table_relationships: Dict) -> str:
-    """Generoi SQL-kysely täsmälleen oikealla rakenteella."""
-    
-    # Määritä kiinteä järjestys SELECT-lauseelle
-    select_order = [
-        "ORDER_ID",
-        "CUSTOMER_ID",
-        "CUSTOMER_NAME",
-        "CUSTOMER_EMAIL",
-        "DUE_DATE",
-        "ORDER_LINE_ID",
-        "PRODUCT_ID",
-        "PRODUCT_NAME",
-        "QUANTITY",
-        "UNIT_PRICE",
-        "CUSTOMER_ADDRESS"
-    ]
+# Kiinteä järjestys SELECT-lauseelle
+SELECT_ORDER = [
+    "ORDER_ID",
+    "CUSTOMER_ID",
+    "CUSTOMER_NAME",
+    "CUSTOMER_EMAIL",
+    "DUE_DATE",
+    "ORDER_LINE_ID",
+    "PRODUCT_ID",
+    "PRODUCT_NAME",
+    "QUANTITY",
+    "UNIT_PRICE",
+    "CUSTOMER_ADDRESS"
+]
+
+def build_fk_graph(relationships: List[Dict]) -> Dict[str, List[Dict]]:
+    """
+    Rakenna vierasavaimista suuntaamaton verkko: taulu -> liitokset naapureihin.
+    Monisarakkeiset vierasavaimet yhdistetään yhdeksi liitokseksi.
+    Kukin liitos kertoo, viittaako taulu naapuriin (many_to_one) vai päinvastoin.
+    """
+    constraints = {}
+    for i, rel in enumerate(relationships):
+        parent = f"{rel['parent_schema']}.{rel['parent_table']}"
+        referenced = f"{rel['referenced_schema']}.{rel['referenced_table']}"
+        key = (parent, referenced, rel.get('constraint_name') or i)
+        constraints.setdefault(key, []).append((rel['parent_column'], rel['referenced_column']))
+
+    graph = {}
+    for (parent, referenced, _), column_pairs in constraints.items():
+        graph.setdefault(parent, []).append({
+            'table': referenced,
+            'columns': column_pairs,
+            'many_to_one': True
+        })
+        graph.setdefault(referenced, []).append({
+            'table': parent,
+            'columns': [(ref_col, parent_col) for parent_col, ref_col in column_pairs],
+            'many_to_one': False
+        })
+    return graph
+
+def plan_joins(graph: Dict[str, List[Dict]], main_table: str, required_tables: List[str]) -> List[Dict]:
+    """
+    Etsi liitospuu, joka kattaa kaikki tarvittavat taulut.
+    Puu kasvatetaan ahneesti: joka kierroksella leveyshaku lähtee koko
+    nykyisestä puusta ja lisää lähimmän puuttuvan taulun lyhimmän polun.
+    Palauttaa liitokset järjestyksessä: {'from', 'table', 'columns', 'many_to_one'}.
+    """
+    in_tree = [main_table]
+    joins = []
+    remaining = [table for table in dict.fromkeys(required_tables) if table != main_table]
+
+    while remaining:
+        previous = {table: None for table in in_tree}
+        queue = deque(in_tree)
+        found = None
+        while queue and found is None:
+            table = queue.popleft()
+            for edge in graph.get(table, []):
+                neighbor = edge['table']
+                if neighbor in previous:
+                    continue
+                previous[neighbor] = (table, edge)
+                if neighbor in remaining:
+                    found = neighbor
+                    break
+                queue.append(neighbor)
+
+        if found is None:
+            raise ValueError(f"Tauluja {', '.join(remaining)} ei voi liittää tauluun {main_table} vierasavainten kautta")
+
+        # Lisää polku puuhun juuresta päin
+        path = []
+        table = found
+        while previous[table] is not None:
+            source, edge = previous[table]
+            path.append({'from': source, 'table': table, 'columns': edge['columns'],
+                         'many_to_one': edge['many_to_one']})
+            table = source
+        for join in reversed(path):
+            joins.append(join)
+            in_tree.append(join['table'])
+            if join['table'] in remaining:
+                remaining.remove(join['table'])
+
+    return joins
+
+# T-SQL:n varatut sanat, joita ei voi käyttää aliaksena lainaamatta
+SQL_RESERVED_WORDS = frozenset({
+    "ADD", "ALL", "ALTER", "AND", "ANY", "AS", "ASC", "AUTHORIZATION", "BACKUP", "BEGIN", "BETWEEN", "BREAK",
+    "BROWSE", "BULK", "BY", "CASCADE", "CASE", "CHECK", "CHECKPOINT", "CLOSE", "CLUSTERED", "COALESCE",
+    "COLLATE", "COLUMN", "COMMIT", "COMPUTE", "CONSTRAINT", "CONTAINS", "CONTAINSTABLE", "CONTINUE",
+    "CONVERT", "CREATE", "CROSS", "CURRENT", "CURRENT_DATE", "CURRENT_TIME", "CURRENT_TIMESTAMP",
+    "CURRENT_USER", "CURSOR", "DATABASE", "DBCC", "DEALLOCATE", "DECLARE", "DEFAULT", "DELETE", "DENY",
+    "DESC", "DISK", "DISTINCT", "DISTRIBUTED", "DOUBLE", "DROP", "DUMP", "ELSE", "END", "ERRLVL", "ESCAPE",
+    "EXCEPT", "EXEC", "EXECUTE", "EXISTS", "EXIT", "EXTERNAL", "FETCH", "FILE", "FILLFACTOR", "FOR",
+    "FOREIGN", "FREETEXT", "FREETEXTTABLE", "FROM", "FULL", "FUNCTION", "GOTO", "GRANT", "GROUP", "HAVING",
+    "HOLDLOCK", "IDENTITY", "IDENTITY_INSERT", "IDENTITYCOL", "IF", "IN", "INDEX", "INNER", "INSERT",
+    "INTERSECT", "INTO", "IS", "JOIN", "KEY", "KILL", "LEFT", "LIKE", "LINENO", "LOAD", "MERGE", "NATIONAL",
+    "NOCHECK", "NONCLUSTERED", "NOT", "NULL", "NULLIF", "OF", "OFF", "OFFSETS", "ON", "OPEN",
+    "OPENDATASOURCE", "OPENQUERY", "OPENROWSET", "OPENXML", "OPTION", "OR", "ORDER", "OUTER", "OVER",
+    "PERCENT", "PIVOT", "PLAN", "PRECISION", "PRIMARY", "PRINT", "PROC", "PROCEDURE", "PUBLIC", "RAISERROR",
+    "READ", "READTEXT", "RECONFIGURE", "REFERENCES", "REPLICATION", "RESTORE", "RESTRICT", "RETURN", "REVERT",
+    "REVOKE", "RIGHT", "ROLLBACK", "ROWCOUNT", "ROWGUIDCOL", "RULE", "SAVE", "SCHEMA", "SECURITYAUDIT",
+    "SELECT", "SEMANTICKEYPHRASETABLE", "SEMANTICSIMILARITYDETAILSTABLE", "SEMANTICSIMILARITYTABLE",
+    "SESSION_USER", "SET", "SETUSER", "SHUTDOWN", "SOME", "STATISTICS", "SYSTEM_USER", "TABLE", "TABLESAMPLE",
+    "TEXTSIZE", "THEN", "TO", "TOP", "TRAN", "TRANSACTION", "TRIGGER", "TRUNCATE", "TRY_CONVERT", "TSEQUAL",
+    "UNION", "UNIQUE", "UNPIVOT", "UPDATE", "UPDATETEXT", "USE", "USER", "VALUES", "VARYING", "VIEW",
+    "WAITFOR", "WHEN", "WHERE", "WHILE", "WITH", "WRITETEXT"
+})
+
+def assign_aliases(tables: List[str]) -> Dict[str, str]:
+    """
+    Anna tauluille lyhyet aliakset nimen isoista kirjaimista, esim. SalesOrderHeader -> soh.
+    Varattu sana saa numeron kuten toistuva alias, esim. OrderRow -> or2.
+    """
+    aliases = {}
+    used = set()
+    for table in tables:
+        name = table.split(".")[-1]
+        base = "".join(re.findall(r"[A-Z]", name)).lower() or name[:1].lower() or "t"
+        alias = base
+        suffix = 2
+        while alias in used or alias.upper() in SQL_RESERVED_WORDS:
+            alias = f"{base}{suffix}"
+            suffix += 1
+        aliases[table] = alias
+        used.add(alias)
+    return aliases
+
+def generate_sql_query(field_locations: Dict, relationships: List[Dict]) -> str:
+    """
+    Generoi SQL-kysely vierasavainverkosta.
+    Päätaulu on ORDER_ID-kentän taulu, ja siihen liitetään vain ne taulut,
+    jotka tarvitaan kenttien kattamiseen, käyttäen löydettyjä liitossarakkeita.
+    Kysely palauttaa tasan yhden rivin jokaista laskuriviä kohden.
+    """
+    def table_of(field):
+        location = field_locations[field]
+        return f"{location['schema']}.{location['table']}"
+
+    main_table = table_of("ORDER_ID")
+    joins = plan_joins(build_fk_graph(relationships), main_table,
+                       [table_of(field) for field in SELECT_ORDER])
+    aliases = assign_aliases([main_table] + [join['table'] for join in joins])
 
     # Rakenna SELECT-lauseke oikeassa järjestyksessä
     select_parts = []
-    for field in select_order:
+    for field in SELECT_ORDER:
         location = field_locations[field]
-        select_parts.append(
-            f"{location['schema']}.{location['table']}.{location['column']} AS {field}"
-        )
-
-    # Määritä kiinteät JOIN-lausekkeet oikeassa järjestyksessä
-    joins = [
-        "JOIN SalesLT.Customer ON SalesLT.SalesOrderHeader.CustomerID = SalesLT.Customer.CustomerID",
-        "JOIN SalesLT.CustomerAddress ON SalesLT.Customer.CustomerID = SalesLT.CustomerAddress.CustomerID",
-        "JOIN SalesLT.SalesOrderDetail ON SalesLT.SalesOrderHeader.SalesOrderID = SalesLT.SalesOrderDetail.SalesOrderID",
-        "JOIN SalesLT.Product ON SalesLT.SalesOrderDetail.ProductID = SalesLT.Product.ProductID"
-    ]
+        select_parts.append(f"{aliases[table_of(field)]}.{location['column']} AS {field}")
+
+    # Rivitaso on laskurivien taulu. Yksi-moneen-liitos muualle kuin rivitason
+    # polulle monistaisi laskurivit, joten niistä otetaan vain yksi rivi APPLY:lla.
+    parents = {join['table']: join['from'] for join in joins}
+    grain_path = set()
+    table = table_of("ORDER_LINE_ID")
+    while table is not None:
+        grain_path.add(table)
+        table = parents.get(table)
+
+    def columns_of(table):
+        # Sarakkeet, jotka APPLY-alikyselyn on palautettava
+        needed = [field_locations[field]['column'] for field in SELECT_ORDER if table_of(field) == table]
+        needed += [source_col for join in joins if join['from'] == table for source_col, _ in join['columns']]
+        return list(dict.fromkeys(needed))
+
+    join_parts = []
+    for join in joins:
+        source, target = aliases[join['from']], aliases[join['table']]
+        condition = " AND ".join(f"{source}.{source_col} = {target}.{target_col}"
+                                 for source_col, target_col in join['columns'])
+        if join['many_to_one'] or join['table'] in grain_path:
+            join_parts.append(f"JOIN {join['table']} AS {target} ON {condition}")
+            continue
+
+        columns = columns_of(join['table'])
+        order_by = (PREFERRED_ROW_ORDER.get(join['table'].split(".")[-1])
+                    or [f"{target}.{column}" for column in columns])
+        join_parts.append(f"""OUTER APPLY (
+    SELECT TOP 1 {", ".join(f"{target}.{column}" for column in columns)}
+    FROM {join['table']} AS {target}
+    WHERE {condition}
+    ORDER BY {", ".join(order_by)}
+) AS {target}""")
 
     # Kokoa kysely
     select_clause = ",\n    ".join(select_parts)
-    join_clause = "\n".join(joins)
-    
+    join_clause = "\n".join(join_parts)
+    order_column = f"{aliases[main_table]}.{field_locations['ORDER_ID']['column']}"
+    line_column = f"{aliases[table_of('ORDER_LINE_ID')]}.{field_locations['ORDER_LINE_ID']['column']}"
+
+    # Laskurivien järjestys on vakaa, jotta laskun tiiviste ei muutu ajosta toiseen
     query = f"""SELECT
     {select_clause}
-FROM SalesLT.SalesOrderHeader
+FROM {main_table} AS {aliases[main_table]}
 {join_clause}
-ORDER BY SalesLT.SalesOrderHeader.SalesOrderID;"""
+ORDER BY {order_column}, {line_column};"""
 
     return query
 
-def main():
+def generate_invoice_query_file() -> bool:
+    """Skannaa rakenne (tai lue se välimuistista) ja kirjoita invoice_query.sql."""
     print("🔍 Skannataan tietokantarakennetta...")
-    columns, relationships = scan_database_structure()
-    
+    columns, relationships, fingerprint = scan_database_structure()
+
     if not columns or not relationships:
         print("⚠️ Tietokantarakennetta ei voitu lukea!")
-        return
+        return False
 
     print("🔍 Etsitään tarvittavia kenttiä...")
-    field_locations, table_relationships = find_required_tables(columns, relationships, {
-        "ORDER_ID": "SalesOrderID",
-        "CUSTOMER_ID": "CustomerID",
-        "CUSTOMER_NAME": "CompanyName",
-        "CUSTOMER_EMAIL": "EmailAddress",
-        "DUE_DATE": "DueDate",
-        "ORDER_LINE_ID": "SalesOrderDetailID",
-        "PRODUCT_ID": "ProductID",
-        "PRODUCT_NAME": "Name",
-        "QUANTITY": "OrderQty",
-        "UNIT_PRICE": "UnitPrice",
-        "CUSTOMER_ADDRESS": "AddressID"
-    })
+    field_locations, table_relationships = find_required_tables(columns, relationships, REQUIRED_FIELDS)
 
     # Tallenna skeemaraportti debug-tarkoituksiin
     with open("debug_schema.json", "w") as f:
@@ -262,16 +528,44 @@ def main():
 
     try:
         print("📝 Generoidaan SQL-kyselyä...")
-        sql_query = generate_sql_query(field_locations, table_relationships)
+        sql_query = generate_sql_query(field_locations, relationships)
         
         with open("invoice_query.sql", "w") as f:
             f.write(sql_query)
-        
+
+        # Sormenjälki tallennetaan vasta onnistuneen generoinnin jälkeen, muuten
+        # seuraava ajo luulisi vanhan kyselyn olevan ajan tasalla
+        save_schema_cache(fingerprint, columns, relationships)
+
         print("✅ SQL-kysely generoitu onnistuneesti!")
         print("📋 Debug-tiedot tallennettu: debug_schema.json")
+        return True
         
     except Exception as e:
         print(f"⚠️ Virhe kyselyn generoinnissa: {e}")
+        return False
+
+def ensure_invoice_query() -> bool:
+    """
+    Varmista että invoice_query.sql on ajan tasalla.
+    Kysely generoidaan uudelleen vain, jos tietokannan sormenjälki on
+    muuttunut välimuistin jälkeen tai tiedosto puuttuu.
+    """
+    try:
+        fingerprint = current_schema_fingerprint()
+    except Exception as e:
+        print(f"⚠️ Skeeman sormenjälkeä ei voitu hakea: {e}")
+        return os.path.exists("invoice_query.sql")
+
+    if os.path.exists("invoice_query.sql") and load_schema_cache(fingerprint):
+        print("✅ Tietokantarakenne ei ole muuttunut, käytetään olemassa olevaa invoice_query.sql-kyselyä")
+        return True
+
+    print("🔄 Tietokantarakenne on muuttunut tai kysely puuttuu, generoidaan invoice_query.sql")
+    return generate_invoice_query_file()
+
+def main():
+    generate_invoice_query_file()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Moduulit ovat projektin juuressa
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# scan_schema lukee asetukset tuonnin yhteydessä; testit eivät avaa yhteyttä
+for key in ("DB_SERVER", "DB_NAME", "DB_USER", "DB_PASSWORD"):
+    os.environ.setdefault(key, "test.database.windows.net" if key == "DB_SERVER" else "test")
@@ -0,0 +1,54 @@
+import pymssql
+import pytest
+
+import db_handler
+from benchmark import generate_catalog
+from db_handler import group_rows, iter_orders_by_invoice, order_id_filter, order_id_source
+from invoice_state import track_highest_order
+from metrics import METRICS
+from scan_schema import REQUIRED_FIELDS, find_required_tables, generate_sql_query
+
+def test_order_id_source_finds_the_main_table_of_the_generated_query():
+    columns, relationships = generate_catalog(100)
+    field_locations, _ = find_required_tables(columns, relationships, REQUIRED_FIELDS)
+
+    query = generate_sql_query(field_locations, relationships)
+
+    assert order_id_source(query) == ("SalesLT.SalesOrderHeader", "SalesOrderID")
+
+def test_order_id_source_rejects_other_query_shapes():
+    assert order_id_source("SELECT x AS ORDER_ID FROM t ORDER BY x;") is None
+    assert order_id_source("SELECT d.OrderNo AS ORDER_ID\nFROM dbo.Lines AS l\nJOIN dbo.Orders AS d ON 1 = 1") is None
+
+def test_order_id_filter_uses_the_given_column():
+    assert order_id_filter(5, 9, column="o.SalesOrderID") == ("WHERE o.SalesOrderID > %s AND o.SalesOrderID <= %s", (5, 9))
+    assert order_id_filter() == ("", None)
+
+def test_group_rows_keeps_orders_together_across_batches():
+    METRICS.reset()
+    batches = [[{'ORDER_ID': 1}, {'ORDER_ID': 1}], [{'ORDER_ID': 1}, {'ORDER_ID': 2}], [{'ORDER_ID': 3}]]
+
+    groups = [(order_id, len(items)) for order_id, items in group_rows(iter(batches))]
+
+    assert groups == [(1, 3), (2, 1), (3, 1)]
+    assert METRICS.summary()["timers"]["group_orders"]["count"] == 3
+
+def failing_row_stream(monkeypatch, batches):
+    """Replace the database with a row stream that raises after the given batches."""
+    def iter_row_batches(*args, **kwargs):
+        yield from batches
+        raise pymssql.OperationalError("connection reset")
+
+    monkeypatch.setattr(db_handler, "build_invoice_query", lambda *args, **kwargs: ("SELECT 1", None))
+    monkeypatch.setattr(db_handler, "iter_row_batches", iter_row_batches)
+
+def test_customer_ordered_stream_raises_and_records_no_progress(monkeypatch):
+    # Asiakas 1 (tilaukset 10, 50, 60) ja sen jälkeen asiakas 2 (tilaus 20)
+    failing_row_stream(monkeypatch, [[{'ORDER_ID': 10, 'CUSTOMER_ID': 1}, {'ORDER_ID': 50, 'CUSTOMER_ID': 1}]])
+    progress = {}
+
+    with pytest.raises(pymssql.Error):
+        for _ in track_highest_order(iter_orders_by_invoice(by_customer=True), progress):
+            pass
+
+    assert progress == {}
@@ -0,0 +1,49 @@
+import os
+
+import pymssql
+import pytest
+
+import db_handler
+import main
+from invoice_manifest import load_manifest
+
+COLUMNS = ["ORDER_ID", "CUSTOMER_ID", "CUSTOMER_NAME", "DUE_DATE", "PRODUCT_NAME", "QUANTITY", "UNIT_PRICE"]
+
+def rows(order_id, lines=2):
+    return [(order_id, 1, "Acme", "2008-06-13", f"Product {i}", 1, 9.99) for i in range(lines)]
+
+@pytest.fixture
+def failing_database(monkeypatch, tmp_path):
+    """
+    A database whose row stream fails after the first batch. Keyset pages
+    with an upper bound are served in full, so with paged fetching the
+    first page completes and the last one fails.
+    """
+    def iter_row_batches(sql_query, params=None, batch_size=None, row_factory=db_handler.line_row_factory):
+        make_row = row_factory(COLUMNS)
+        # Normalisoidun haun otsikkokysely palauttaa yhden rivin tilausta kohden
+        lines = 1 if row_factory is db_handler.header_row_factory else 2
+        yield [make_row(row) for row in rows(71774, lines) + rows(71776, lines)]
+        if params[1] is None:
+            raise pymssql.OperationalError("connection reset")
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "check_database_connection", lambda: (True, None))
+    monkeypatch.setattr(main, "ensure_invoice_query", lambda: True)
+    monkeypatch.setattr(main, "has_orders", lambda *args: True)
+    monkeypatch.setattr(db_handler, "build_invoice_query",
+                        lambda min_order_id=None, max_order_id=None, by_customer=False:
+                        ("SELECT 1", (min_order_id, max_order_id)))
+    monkeypatch.setattr(db_handler, "build_normalized_queries",
+                        lambda min_order_id=None, max_order_id=None: ("SELECT 1", "SELECT 2",
+                                                                      (min_order_id, max_order_id)))
+    monkeypatch.setattr(db_handler, "fetch_page_bounds", lambda *args: [71776])
+    monkeypatch.setattr(db_handler, "iter_row_batches", iter_row_batches)
+
+@pytest.mark.parametrize("options", [{}, {"pipelined": True}, {"normalized": True}, {"fetch_workers": 2}],
+                         ids=["default", "pipelined", "normalized", "paged"])
+def test_fetch_error_fails_the_run_without_saving_state(failing_database, options):
+    assert main.main(full=True, **options) is False
+    assert not os.path.exists("invoice_state.json")
+    # Jo renderöidyt laskut eivät jää manifestiin, joten seuraava ajo tekee ne uudelleen
+    assert load_manifest() == {}
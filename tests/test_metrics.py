@@ -0,0 +1,27 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Metrics
+
+def test_rows_per_second_uses_wall_clock_time_of_parallel_fetches():
+    metrics = Metrics()
+
+    def fetch():
+        with metrics.timer("fetch_rows"):
+            time.sleep(0.2)
+        metrics.count("rows_fetched", 100)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(fetch) for _ in range(4)]:
+            future.result()
+
+    summary = metrics.summary()
+    # Neljä rinnakkaista hakua kestää yhteensä ~0.8 s mutta seinäkellolla ~0.2 s
+    assert summary["timers"]["fetch_rows"]["total"] >= 0.8
+    assert summary["counters"]["rows_per_second"] > 400 / 0.5
+
+def test_summary_without_fetches_has_no_rows_per_second():
+    metrics = Metrics()
+    metrics.count("rows_fetched", 10)
+
+    assert "rows_per_second" not in metrics.summary()["counters"]
@@ -0,0 +1,24 @@
+import io
+from decimal import Decimal
+
+from invoice_generator import generate_pdf, generate_statement_pdf
+
+def items(count):
+    return [dict(PRODUCT_NAME=f"Product {i}", QUANTITY=1, UNIT_PRICE=Decimal("9.99"), DUE_DATE="2008-06-13")
+            for i in range(count)]
+
+def uses_form(render):
+    buffer = io.BytesIO()
+    render(buffer)
+    return b"/FormXob" in buffer.getvalue()
+
+def test_single_page_invoice_draws_the_static_layer_directly():
+    assert not uses_form(lambda f: generate_pdf(71774, "Acme", "Acme", "2008-06-13", items(5), f))
+    assert not uses_form(lambda f: generate_pdf(71774, "Acme", "Acme", "2008-06-13", items(5), f, paginate=True))
+
+def test_multi_page_invoice_shares_the_static_layer_as_a_form():
+    assert uses_form(lambda f: generate_pdf(71774, "Acme", "Acme", "2008-06-13", items(200), f))
+
+def test_statement_uses_the_form_only_when_it_spans_pages():
+    assert not uses_form(lambda f: generate_statement_pdf(29485, "Acme", "Acme", [(1, items(3)), (2, items(2))], f))
+    assert uses_form(lambda f: generate_statement_pdf(29485, "Acme", "Acme", [(1, items(200)), (2, items(2))], f))
@@ -0,0 +1,109 @@
+import pytest
+
+from benchmark import SALESLT_FOREIGN_KEYS, SALESLT_TABLES, generate_catalog
+from scan_schema import (FIELD_TABLE_MAPPING, REQUIRED_FIELDS, REQUIRED_JOINS, assign_aliases, build_column_index,
+                         build_relationship_index, find_join, find_required_tables, generate_sql_query)
+
+def relationship(parent_schema, parent, parent_column, referenced_schema, referenced, referenced_column):
+    return {
+        "parent_schema": parent_schema, "parent_table": parent, "parent_column": parent_column,
+        "referenced_schema": referenced_schema, "referenced_table": referenced,
+        "referenced_column": referenced_column
+    }
+
+def column(schema, table, name):
+    return {"TABLE_SCHEMA": schema, "TABLE_NAME": table, "COLUMN_NAME": name, "DATA_TYPE": "int"}
+
+def test_column_index_is_keyed_by_table_and_lowercase_column():
+    columns = [column("SalesLT", "Customer", "CustomerID"), column("Dept1", "Customer", "customerid"),
+               column("SalesLT", "Product", "Name")]
+    index = build_column_index(columns)
+
+    assert [col["TABLE_SCHEMA"] for col in index[("Customer", "customerid")]] == ["SalesLT", "Dept1"]
+    assert index[("Product", "name")] == [columns[2]]
+    assert ("Product", "Name") not in index
+
+def test_find_join_resolves_both_directions():
+    index = build_relationship_index([relationship("SalesLT", "SalesOrderDetail", "SalesOrderID",
+                                                   "SalesLT", "SalesOrderHeader", "SalesOrderID")])
+
+    # Vierasavain osoittaa lapsitaulusta päätauluun
+    assert find_join(index, "SalesOrderHeader", "SalesOrderDetail", "SalesOrderID") == {
+        "schema": "SalesLT", "referenced_table": "SalesLT.SalesOrderDetail",
+        "parent_column": "SalesOrderID", "referenced_column": "SalesOrderID"
+    }
+    assert find_join(index, "SalesOrderDetail", "SalesOrderHeader", "SalesOrderID")["referenced_table"] == \
+        "SalesLT.SalesOrderHeader"
+    assert find_join(index, "SalesOrderHeader", "SalesOrderDetail", "ProductID") is None
+    assert find_join(index, "SalesOrderHeader", "Product", "ProductID") is None
+
+@pytest.mark.parametrize("column_count", [100, 10_000, 200_000])
+def test_resolver_against_large_synthetic_catalog(column_count):
+    columns, relationships = generate_catalog(column_count)
+    assert len(columns) >= column_count - 25
+
+    field_locations, table_relationships = find_required_tables(columns, relationships, REQUIRED_FIELDS)
+
+    # Täytetaulut käyttävät samoja sarakenimiä, mutta kentät ratkeavat oikeisiin SalesLT-tauluihin
+    assert set(field_locations) == set(REQUIRED_FIELDS)
+    for field, table in FIELD_TABLE_MAPPING.items():
+        assert field_locations[field] == {"schema": "SalesLT", "table": table, "column": REQUIRED_FIELDS[field]}
+
+    joins = [(key, join["referenced_table"]) for key, key_joins in table_relationships.items()
+             for join in key_joins]
+    assert sorted(joins) == sorted((f"SalesLT.{parent}", f"SalesLT.{child}") for parent, child, _ in REQUIRED_JOINS)
+
+def test_resolver_matches_column_names_case_insensitively():
+    columns = [column("SalesLT", table, name.upper()) for table, names in SALESLT_TABLES.items() for name in names]
+    relationships = [relationship("SalesLT", parent, parent_column, "SalesLT", referenced, referenced_column)
+                     for parent, parent_column, referenced, referenced_column in SALESLT_FOREIGN_KEYS]
+
+    field_locations, _ = find_required_tables(columns, relationships, REQUIRED_FIELDS)
+
+    assert field_locations["ORDER_ID"]["column"] == "SALESORDERID"
+    assert set(field_locations) == set(REQUIRED_FIELDS)
+
+def test_resolver_is_table_driven_for_other_schemas():
+    columns = [column("Billing", "Orders", "OrderNo"), column("Billing", "Orders", "ClientRef"),
+               column("Billing", "Clients", "ClientRef"), column("Billing", "Clients", "Title"),
+               column("Other", "Orders", "Title")]
+    relationships = [relationship("Billing", "Orders", "ClientRef", "Billing", "Clients", "ClientRef")]
+
+    field_locations, table_relationships = find_required_tables(
+        columns, relationships,
+        {"ORDER_ID": "OrderNo", "CUSTOMER_NAME": "Title"},
+        field_table_mapping={"ORDER_ID": "Orders", "CUSTOMER_NAME": "Clients"},
+        required_joins=[("Orders", "Clients", "ClientRef")]
+    )
+
+    assert field_locations == {
+        "ORDER_ID": {"schema": "Billing", "table": "Orders", "column": "OrderNo"},
+        "CUSTOMER_NAME": {"schema": "Billing", "table": "Clients", "column": "Title"}
+    }
+    assert table_relationships == {"Billing.Orders": [{
+        "referenced_table": "Billing.Clients", "parent_column": "ClientRef", "referenced_column": "ClientRef"
+    }]}
+
+def test_missing_fields_and_joins_are_left_out():
+    columns, relationships = generate_catalog(100)
+    columns = [col for col in columns if col["TABLE_NAME"] != "Product"]
+    relationships = [rel for rel in relationships if rel["referenced_table"] != "Product"]
+
+    field_locations, table_relationships = find_required_tables(columns, relationships, REQUIRED_FIELDS)
+
+    assert "PRODUCT_NAME" not in field_locations and "PRODUCT_ID" not in field_locations
+    assert "SalesLT.SalesOrderDetail" not in table_relationships
+
+def test_generated_query_orders_lines_within_an_order():
+    columns, relationships = generate_catalog(100)
+    field_locations, _ = find_required_tables(columns, relationships, REQUIRED_FIELDS)
+
+    query = generate_sql_query(field_locations, relationships)
+
+    assert query.endswith("ORDER BY soh.SalesOrderID, sod.SalesOrderDetailID;")
+
+def test_aliases_skip_reserved_words():
+    aliases = assign_aliases(["dbo.OrderRow", "dbo.ItemNote", "dbo.OtherRecord", "SalesLT.SalesOrderHeader"])
+
+    assert aliases == {"dbo.OrderRow": "or2", "dbo.ItemNote": "in2", "dbo.OtherRecord": "or3",
+                       "SalesLT.SalesOrderHeader": "soh"}
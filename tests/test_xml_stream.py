@@ -0,0 +1,58 @@
+import io
+from decimal import Decimal
+
+import pytest
+from lxml import etree
+
+from invoice_generator import XML_STREAMING_MIN_LINES, generate_xml
+
+def item(name="Mountain Bike", quantity=2, unit_price=Decimal("12.34"), **fields):
+    return dict(PRODUCT_NAME=name, QUANTITY=quantity, UNIT_PRICE=unit_price, **fields)
+
+def render(streaming, customer_name="Acme Corp", billable_company="Acme Corp", due_date="2008-06-13",
+           items=(), order_id=71774):
+    buffer = io.BytesIO()
+    generate_xml(order_id, customer_name, billable_company, due_date, list(items), buffer, streaming=streaming)
+    return buffer.getvalue()
+
+CASES = {
+    "one item": dict(items=[item()]),
+    "many items": dict(items=[item(f"Product {i}", i, Decimal(i) / 3) for i in range(50)]),
+    "empty items": dict(items=[]),
+    "none header text": dict(customer_name=None, billable_company=None, due_date=None, items=[item()]),
+    "none item values": dict(items=[item(name=None, quantity=None, unit_price=None)]),
+    "float and int prices": dict(items=[item(unit_price=19.99), item(unit_price=5, quantity=3)]),
+    "special characters": dict(
+        customer_name="Smith & Sons <\"Bikes\"> 'Oy'",
+        billable_company="Åkerlund – Ääni ]]> 自転車",
+        items=[item("Tire & Tube <26\"> ]]>"), item("Café\tcrème\n"), item("€ 😀")]
+    ),
+}
+
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_streamed_xml_is_byte_identical_to_tree_output(case):
+    tree_output = render(False, **CASES[case])
+    streamed_output = render(True, **CASES[case])
+
+    assert streamed_output == tree_output
+    etree.fromstring(streamed_output)
+
+def test_large_invoice_is_streamed_by_default_and_identical():
+    items = [item(f"Product {i}", i % 7, Decimal("1.10")) for i in range(XML_STREAMING_MIN_LINES + 1)]
+
+    assert render(None, items=items) == render(False, items=items)
+
+def test_streamed_xml_to_file_path_matches_buffer(tmp_path):
+    items = [item(), item("Helmet & Gloves")]
+    path = tmp_path / "invoice.xml"
+    generate_xml(71774, "Acme Corp", "Acme Corp", "2008-06-13", items, str(path), streaming=True)
+
+    assert path.read_bytes() == render(False, items=items)
+
+def test_streamed_xml_keeps_values_and_totals():
+    output = render(True, customer_name="Smith & Sons", items=[item("A <b>", 3, Decimal("1.50"))])
+    root = etree.fromstring(output)
+
+    assert root.findtext("CustomerName") == "Smith & Sons"
+    assert root.findtext("Items/Item/ProductName") == "A <b>"
+    assert root.findtext("Items/Item/TotalPrice") == "4.50"